@@ -5,15 +5,183 @@ from PyQt5.QtGui import QPixmap, QMovie
 from PyQt5.QtCore import Qt, QThread, pyqtSlot as Slot, pyqtSignal as Signal, QTimer, QObject, QEvent
 from functools import partial
 import requests as req
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.exceptions import ProtocolError
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import json
 import re
 import time
 import sys
-
-#mocks the requests import to add the Authorization header to all outgoing requests
-requests = req.session()
-requests.headers["Authorization"] = "Bearer {}".format(os.getenv("KEY"))
+from datetime import datetime
+from collections import deque, OrderedDict
+from offline import LocalStore
 
 SERVER_URL=os.getenv("URL") or "http://localhost:5000"
+
+#how many requests to the server can run at once, every Requester shares these threads
+REQUEST_WORKERS = int(os.getenv("REQUEST_WORKERS") or 4)
+#seconds to wait for a connection and then for a response, so a dead server can't hang a worker forever
+REQUEST_TIMEOUT = (3.05, 15)
+
+#requests sessions aren't safe to use from several threads at once, so each worker thread gets its own
+#every session adds the Authorization header to all outgoing requests and keeps its connection to the server alive
+session_store = threading.local()
+
+def get_session():
+    session = getattr(session_store, "session", None)
+    if session is None:
+        session = req.Session()
+        session.headers["Authorization"] = "Bearer {}".format(os.getenv("KEY"))
+        #failed connections are retried for any request, but only GETs are retried after the server has seen them
+        retries = Retry(total=2, connect=2, read=1, status=1, backoff_factor=0.2,
+                        status_forcelist=(502, 503, 504), allowed_methods=frozenset(["GET", "HEAD"]))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=retries)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session_store.session = session
+    return session
+
+#the reasons set on responses made up by send_request when there's no answer from the server
+#offline means the request never got to the server, so it's safe to save it and send it again later
+OFFLINE_REASON = "Connection failed"
+#unanswered means it was sent but the answer never came back (i.e. it timed out), so the server may have done it already
+UNANSWERED_REASON = "No response"
+
+#whether a request failed before it got to the server. A connection dropped partway through (ProtocolError)
+#may have been sent already, so it doesn't count
+def never_sent(e):
+    return isinstance(e, req.ConnectionError) and not (len(e.args) > 0 and isinstance(e.args[0], ProtocolError))
+
+#makes a request on the current thread. Network errors come back as a 503 or 504 response with an error message
+#instead of an exception, since every caller already checks status_code (use is_offline to tell them apart)
+def send_request(method, path, **kwargs):
+    kwargs.setdefault("timeout", REQUEST_TIMEOUT)
+    try:
+        return getattr(get_session(), method)(SERVER_URL + path, **kwargs)
+    except req.RequestException as e:
+        print("Request to {} failed: {}".format(path, e))
+        response = req.Response()
+        if never_sent(e):
+            response.status_code = 503
+            response.reason = OFFLINE_REASON
+            error = "Error contacting server"
+        else:
+            response.status_code = 504
+            response.reason = UNANSWERED_REASON
+            error = "No answer from the server, check your items to see if this went through"
+        response.url = SERVER_URL + path
+        response.headers["Content-Type"] = "application/json"
+        response._content = json.dumps({"error": error}).encode()
+        return response
+
+def is_offline(response):
+    return response.reason == OFFLINE_REASON
+
+def is_unanswered(response):
+    return response.reason == UNANSWERED_REASON
+
+request_pool = ThreadPoolExecutor(max_workers=REQUEST_WORKERS)
+#GETs that are waiting for a response, so asking for the same thing twice (i.e. the same image on a receipt) only sends it once
+in_flight = {}
+in_flight_lock = threading.Lock()
+
+#queues a request on the worker pool and returns a Future for its response
+def submit_request(method, path, **kwargs):
+    #only plain GETs are shared, anything with a body or extra options is sent as is
+    if method != "get" or set(kwargs) - {"params"}:
+        return request_pool.submit(send_request, method, path, **kwargs)
+
+    key = (path, json.dumps(kwargs.get("params"), sort_keys=True, default=str))
+    with in_flight_lock:
+        future = in_flight.get(key)
+        if future is None:
+            future = request_pool.submit(send_request, method, path, **kwargs)
+            in_flight[key] = future
+
+    def forget(_):
+        with in_flight_lock:
+            if in_flight.get(key) is future:
+                del in_flight[key]
+    future.add_done_callback(forget)
+    return future
+
+#local copy of the items and users, plus checkouts waiting to be sent (see offline.py)
+local_store = LocalStore(os.path.expanduser(os.getenv("OFFLINE_DB") or "~/.local/share/lmao/offline.db"))
+#seconds between syncs with the server
+SYNC_INTERVAL = int(os.getenv("SYNC_INTERVAL") or 60)
+#sends everything in the outbox to the server, oldest first. Returns False if the server couldn't be reached
+def replay_outbox():
+    for entry in local_store.pending():
+        response = send_request(entry["method"], entry["path"], json=entry["body"])
+        #an unanswered entry is kept and sent again later. If it did go through the first time, the bulk endpoints
+        #answer the second one with "already checked out/in" for each item instead of doing it twice
+        if is_offline(response) or is_unanswered(response):
+            return False
+
+        try:
+            result = response.json()
+        except ValueError:
+            result = {"error": response.text}
+
+        if response.status_code != 200:
+            error = result.get("error") if isinstance(result, dict) else response.text
+        else:
+            #bulk checkouts answer with one result per item, any of which could have been turned down
+            failed = [r for r in result if "error" in r] if isinstance(result, list) else []
+            error = json.dumps(failed) if len(failed) > 0 else None
+
+        local_store.finish(entry, response.status_code, error)
+        if error is not None:
+            print("Conflict replaying {} {} from {}: {}".format(entry["method"].upper(), entry["path"], datetime.fromtimestamp(entry["created"]), error))
+    return True
+
+#pulls everything that changed on the server since the last sync into the local copy. Returns False if the server couldn't be reached
+#the first sync (or one after the local copy is wiped) gets every item and user, after that only what changed
+def refresh_items():
+    params = {"tables": "items,users"}
+    cursor = local_store.get_meta("sync_cursor")
+    if cursor is not None:
+        params["cursor"] = cursor
+
+    response = send_request("get", "/sync", params=params)
+    if response.status_code != 200:
+        return False
+
+    changed = {"items": [], "users": []}
+    deleted = {"items": [], "users": []}
+    next_cursor = None
+    #the server no longer knows everything that was deleted since the cursor, so it sent every row instead
+    reset = False
+    for line in response.text.splitlines():
+        change = json.loads(line)
+        if "reset" in change:
+            reset = True
+        elif "cursor" in change:
+            next_cursor = change["cursor"]
+        elif "row" in change:
+            changed[change["table"]].append(change["row"])
+        else:
+            deleted[change["table"]].append(change["deleted"])
+
+    #the cursor is the last line, so if it's missing the response was cut short and the whole sync is tried again next time
+    if next_cursor is None:
+        return False
+
+    local_store.save_items(changed["items"])
+    local_store.delete_items(deleted["items"])
+    local_store.save_users(changed["users"])
+    local_store.delete_users(deleted["users"])
+    if reset:
+        local_store.keep_only("items", [i["id"] for i in changed["items"]])
+        local_store.keep_only("users", [u["id"] for u in changed["users"]])
+    local_store.set_meta("sync_cursor", next_cursor)
+    return True
+
+#runs on the worker pool every SYNC_INTERVAL seconds, returns whether the server could be reached
+def sync():
+    return replay_outbox() and refresh_items()
 #qss for warning message boxes
 MESSAGE_BOX_QSS = """
                 QLabel {
@@ -45,12 +213,29 @@ class ApplicationController:
         self.user_info = {}
         self.logged_in = False
         self.last_click = time.time()
+        self.scanner = None
+        self.rfid = None
+        self.user_lookup = None
+        #the logged in user's checked out items, fetched along with the user at login so ItemsOutScreen opens straight away.
+        #None until they arrive, or once they're out of date (see forget_open_items)
+        self.open_items = None
+        self.open_items_lookup = None
+        #bumped whenever open_items goes out of date, so a lookup that was already running knows not to save its result
+        self.open_items_generation = 0
+        #whether the server could be reached the last time we tried
+        self.online = True
+        self.sync_job = None
 
         #this timer checks for inactivity every second (1000ms)
         timer = QTimer(self.view.widget)
         timer.timeout.connect(self.handle_timeout_timer)
         timer.start(1000)
 
+        #this one keeps the local copy of the item list up to date and sends anything done while offline
+        sync_timer = QTimer(self.view.widget)
+        sync_timer.timeout.connect(self.start_sync)
+        sync_timer.start(SYNC_INTERVAL * 1000)
+
     #sets last click to current time
     def set_last_click(self):
         self.last_click = time.time()
@@ -70,11 +255,114 @@ class ApplicationController:
     def get_username(self):
         return self.user_info.get("name", "")
 
+    #syncs with the server on the worker pool, unless a sync is already running
+    def start_sync(self):
+        if self.sync_job is not None and not self.sync_job.done():
+            return
+        self.sync_job = request_pool.submit(sync)
+        self.sync_job.add_done_callback(self.finish_sync)
+
+    def finish_sync(self, job):
+        try:
+            self.online = job.result()
+        except Exception as e:
+            print("Sync failed: {}".format(e))
+
+    #stops any background threads the controller owns, called when the app is closing
+    def shut_down(self):
+        if self.scanner is not None:
+            self.scanner.stop()
+        if self.rfid is not None:
+            self.rfid.stop()
+
+    #starts polling the RFID reader, which then keeps running for the life of the app
+    def get_rfid(self):
+        if self.rfid is None:
+            self.rfid = RfidController()
+            self.rfid.found.connect(self.handle_card)
+            self.rfid.start()
+        return self.rfid
+
+    #called on the UI thread when a card is tapped, looks up its owner in the background
+    def handle_card(self, card_id):
+        #cards are only used to log in, so ignore taps anywhere but the start screen or while a lookup is running
+        if self.current_widget not in ("", StartScreen.__name__) or self.user_lookup is not None:
+            return
+
+        #users who have used this terminal before are logged in straight away, even without the server
+        known_user = local_store.find_user(card_id)
+        if known_user is not None:
+            self.set_user_info(known_user)
+            self.go_to_widget(MainScreen)
+            #their items still come from the server, in the background
+            self.open_items_lookup = Requester(self.view, "get", "/user/login", params={"gtid": card_id})
+            self.open_items_lookup.complete.connect(partial(self.handle_open_items, self.open_items_lookup))
+            self.open_items_lookup.start()
+            return
+
+        #gets the user and their checked out items in one go
+        self.user_lookup = Requester(self.view, "get", "/user/login", params={"gtid": card_id})
+        self.user_lookup.complete.connect(partial(self.handle_user_lookup, card_id))
+        self.user_lookup.start()
+
+    #begins the login process once the user lookup comes back
+    def handle_user_lookup(self, card_id, info):
+        self.user_lookup = None
+        if info.status_code == 404:
+            #doesn't exist, so show the create user screen and pass the GTID of the new user
+            self.go_to_widget(NameScreen, card_id)
+        elif info.status_code == 200:
+            login = info.json()
+            local_store.save_user(login["user"])
+            self.set_user_info(login["user"])
+            self.open_items = login["items"]
+            self.go_to_widget(MainScreen)
+        elif is_offline(info):
+            self.online = False
+            msg = QMessageBox(QMessageBox.Icon.Warning, "", "Can't reach the server")
+            msg.setInformativeText("This badge hasn't been used on this terminal before, so it can't be looked up until the server is back")
+            msg.setWindowFlags(Qt.FramelessWindowHint)
+            msg.setStyleSheet(MESSAGE_BOX_QSS)
+            msg.exec()
+        else:
+            print("User lookup failed with status {}".format(info.status_code))
+
+    #the background lookup for a user who was logged in from the local copy
+    def handle_open_items(self, requester, info):
+        #the user logged out or checked something in or out while this was running, so it's out of date
+        if requester is not self.open_items_lookup:
+            return
+        self.open_items_lookup = None
+        if info.status_code == 200:
+            login = info.json()
+            local_store.save_user(login["user"])
+            self.open_items = login["items"]
+
+    #called when the user's checked out items change or they log out
+    def forget_open_items(self):
+        self.open_items = None
+        self.open_items_lookup = None
+        self.open_items_generation += 1
+
+    #the barcode scanner is opened the first time a scan screen needs it and stays open after that
+    def get_scanner(self):
+        if self.scanner is None:
+            self.scanner = ScannerController()
+            self.scanner.start()
+        return self.scanner
+
     #Sets up the interface for another user
     #Clears their UserInfo and logs them out, then removes widgets from the router
     def log_out(self):
         self.user_info = {}
+        self.logged_in = False
+        self.forget_open_items()
         for _, w in self.widgets.items():
+            #gives screens a chance to clean up (i.e. stop listening to the scanner), same as go_to_widget does
+            try:
+                w["component"].on_remove()
+            except:
+                pass
             self.view.stack.removeWidget(w["component"])
         self.widgets = {}
         self.go_to_widget(StartScreen)
@@ -113,6 +401,95 @@ class ApplicationController:
 
         self.current_widget = page.__name__
         
+#size (in px) that item images are shown at in lists
+THUMBNAIL_SIZE = 60
+
+#Item images never change once they're uploaded (a new image gets a new ID), so they can be kept forever without
+#asking the server if they're still current. This keeps them in two places:
+# - in memory, already decoded and scaled, for the images on screen and the ones shown recently
+# - on disk, so they survive restarts. The oldest files are thrown out once the folder goes over its size limit
+class ImageCache:
+    def __init__(self, folder, max_disk_bytes, max_memory_entries):
+        self.folder = folder
+        self.max_disk_bytes = max_disk_bytes
+        self.max_memory_entries = max_memory_entries
+        self.pixmaps = OrderedDict()
+
+        os.makedirs(self.folder, exist_ok=True)
+        self.disk_bytes = 0
+        for f in os.listdir(self.folder):
+            path = os.path.join(self.folder, f)
+            if f.endswith(".tmp"):
+                #left behind by a write that was cut off (i.e. the Pi lost power), never finished so never used
+                os.remove(path)
+            else:
+                self.disk_bytes += os.path.getsize(path)
+
+    def path_for(self, image_id):
+        return os.path.join(self.folder, "{}-{}.jpg".format(image_id, THUMBNAIL_SIZE))
+
+    #returns the scaled QPixmap for an image, or None if it has to be downloaded
+    def get(self, image_id):
+        if image_id in self.pixmaps:
+            self.pixmaps.move_to_end(image_id)
+            return self.pixmaps[image_id]
+
+        path = self.path_for(image_id)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            pixmap = self.remember(image_id, f.read())
+        #the file's modified time is used as its last use time for eviction
+        os.utime(path)
+        return pixmap
+
+    #saves freshly downloaded image bytes to both caches, returns the scaled QPixmap
+    def put(self, image_id, data):
+        pixmap = self.remember(image_id, data)
+        if pixmap.isNull():
+            #not an image (i.e. an error page), don't keep it
+            return pixmap
+
+        path = self.path_for(image_id)
+        tmp_path = path + ".tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            #the same image can be downloaded again (i.e. after it was dropped from memory), which replaces the old file
+            old_size = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(tmp_path, path)
+            self.disk_bytes += len(data) - old_size
+            self.trim_disk()
+        except OSError as e:
+            #a full or read-only SD card shouldn't stop the image from being shown
+            print("Could not cache image {}: {}".format(image_id, e))
+        return pixmap
+
+    #decodes and scales an image once and keeps the result in memory
+    def remember(self, image_id, data):
+        pixmap = QPixmap()
+        pixmap.loadFromData(data)
+        pixmap = pixmap.scaled(THUMBNAIL_SIZE, THUMBNAIL_SIZE, Qt.KeepAspectRatio)
+        if not pixmap.isNull():
+            self.pixmaps[image_id] = pixmap
+            self.pixmaps.move_to_end(image_id)
+            while len(self.pixmaps) > self.max_memory_entries:
+                self.pixmaps.popitem(last=False)
+        return pixmap
+
+    #deletes the least recently used files until the folder is back under 90% of its limit
+    def trim_disk(self):
+        if self.disk_bytes <= self.max_disk_bytes:
+            return
+
+        files = [os.path.join(self.folder, f) for f in os.listdir(self.folder)]
+        files.sort(key=os.path.getmtime)
+        for path in files:
+            if self.disk_bytes <= self.max_disk_bytes * 0.9:
+                break
+            self.disk_bytes -= os.path.getsize(path)
+            os.remove(path)
+
 #This class shows a loading gif in a window, useful for actions that take time
 #will only display full gif if action takes place in another thread, i.e. Requester
 class LoadWindow(QMainWindow):
@@ -137,90 +514,224 @@ class LoadWindow(QMainWindow):
 
         self.setWindowState(Qt.WindowActive)
 
+#how long a read on the scanner's serial port waits for data before checking if it should stop
+SCANNER_READ_TIMEOUT = 0.5
+
+#the scan latency summary is printed every this many scans
+SCAN_REPORT_EVERY = 50
+
+#keeps track of how long it takes from a barcode being read off the scanner to the item showing up on screen
+class ScanMetrics:
+    def __init__(self, keep=100):
+        #only the most recent scans are kept so this doesn't grow forever on a long running terminal
+        self.latencies = deque(maxlen=keep)
+        self.count = 0
+
+    #read_at is the time.monotonic() the scanner thread read the barcode at
+    def record(self, read_at):
+        self.latencies.append(time.monotonic() - read_at)
+        self.count += 1
+        if self.count % SCAN_REPORT_EVERY == 0:
+            print("Scan latency: {}".format(self.summary()))
+
+    #count is every scan since startup, the rest only cover the most recent ones
+    def summary(self):
+        if len(self.latencies) == 0:
+            return {"count": self.count}
+        ordered = sorted(self.latencies)
+        return {
+            "count": self.count,
+            "avg_ms": round(sum(ordered) / len(ordered) * 1000),
+            "p95_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000),
+            "max_ms": round(ordered[-1] * 1000)
+        }
+
 #This class is for the thread to listen for the scanner via serial connection
+#There is only one of these for the whole app (see ApplicationController.get_scanner), scan screens connect to
+#the item signal while they're open instead of opening the port themselves
 class ScannerController(QThread):
-    item = Signal(str)
+    #the barcode and the time.monotonic() it was read at, so the time it takes to reach the UI thread is counted too
+    item = Signal(str, float)
+
+    def __init__(self):
+        super().__init__()
+        self.serial = None
+        self.metrics = ScanMetrics()
 
     def run(self):
-        self.serial = serial.Serial(os.getenv('SCANNER_SERIAL_PORT'))
-        while self.serial.is_open:
+        buffer = b""
+        while not self.isInterruptionRequested():
             try:
-                if self.serial.in_waiting:
-                    line = self.serial.readline().decode()
-                    if line.strip("\r\n"):
-                        self.item.emit(line.strip("\r\n"))
-            except:
-                #ignores weird errors with serial closing. If there's weird problems, try catching the error that gets ignored here!
+                if self.serial is None:
+                    self.serial = serial.Serial(os.getenv('SCANNER_SERIAL_PORT'), timeout=SCANNER_READ_TIMEOUT)
+
+                #blocks until a full line comes in or the timeout passes, so the thread sleeps instead of spinning
+                #the timeout is what lets stop() end the thread
+                buffer += self.serial.readline()
+                if not buffer.endswith(b"\n"):
+                    #timed out partway through a line (or with nothing at all), keep what we have and wait for the rest
+                    continue
+
+                read_at = time.monotonic()
+                line = buffer.decode().strip("\r\n")
+                buffer = b""
+                if line:
+                    self.item.emit(line, read_at)
+            except (serial.SerialException, OSError) as e:
+                #the scanner was unplugged or the port isn't there yet, try again in a second
+                print("Scanner error: {}".format(e))
+                self.close_port()
+                buffer = b""
+                time.sleep(1)
+            except UnicodeDecodeError:
+                buffer = b""
+
+        self.close_port()
+
+    def close_port(self):
+        if self.serial is not None:
+            try:
+                self.serial.close()
+            except Exception:
                 pass
+            self.serial = None
+
+    #asks the thread to finish and waits for it, takes at most SCANNER_READ_TIMEOUT
+    def stop(self):
+        self.requestInterruption()
+        self.wait()
+
+#how often the RFID reader is polled, in seconds. Polling starts fast and slows down the longer no card is seen,
+#then snaps back to fast as soon as one shows up
+RFID_MIN_INTERVAL = 0.05
+RFID_MAX_INTERVAL = 0.5
+#a card that has been sitting on the reader longer than this (in ms) is ignored
+RFID_MAX_HOLD = 2000
+#the same card isn't reported again within this many seconds, so one tap is one login
+RFID_REPEAT_DELAY = 3
 
 #This class is for the thread to poll the RFID reader via serial connection
+#There is only one of these for the whole app (see ApplicationController.get_rfid), and it keeps the port open the whole time
+#It only reads cards, looking up who they belong to is left to the controller so polling is never held up by the network
 class RfidController(QThread):
-    found = Signal(tuple)
+    #emits the card's ID as a string, since they're too big for a Qt int
+    found = Signal(str)
 
-    def run(self):
-        self.serial = serial.Serial(os.getenv('RFID_SERIAL_PORT'))
+    def __init__(self):
+        super().__init__()
+        self.serial = None
+        self.last_card = None
+        self.last_card_time = 0
+
+    def open_port(self):
+        self.serial = serial.Serial(os.getenv('RFID_SERIAL_PORT'), timeout=1)
         #Send settings to RFID reader and clear the last read card (in case one was scanned before we start polling)
         self.serial.write(b"rfid:cmd.echo=0\nrfid:cmd.prompt=0\nrfid:qid.id.hold\n")
         self.serial.reset_input_buffer()
-        while self.serial.is_open:
-            #request a card
-            self.serial.write(b"rfid:qid.id\n")
-            #read the data from the request
+
+    #asks the reader for a card, returns (card id, how long it has been on the reader in ms), or None if there's no card
+    def poll(self):
+        #request a card
+        self.serial.write(b"rfid:qid.id\n")
+        #read the data from the request
+        line = self.serial.readline()
+        while line == b'\r\n' or line == b'\n':
+            #ignore empty lines
             line = self.serial.readline()
-            while line == b'\r\n' or line == b'\n':
-                #ignore empty lines
-                line = self.serial.readline()
-            
+
+        try:
+            #a response looks like {0x00BB,1,0x0000,80;0x000000801CD1931B2F14}, we want the number stored in the last index
+            #more available at https://www.rfideas.com/sites/default/files/2020-01/ASCII_Manual.pdf
+            sanitized_data = re.sub("[{}\r\n]", "", line.decode())
+            card_info = sanitized_data.split(',')
+            #time is in intervals of 48ms
+            held_ms = int(card_info[0], 16) * 48
+            card_id = int(card_info[3].split(';')[1], 16)
+        except (ValueError, IndexError, UnicodeDecodeError):
+            #timed out or garbled, treat it like no card
+            return None
+
+        #0 means no card read
+        if card_id == 0:
+            return None
+        return (card_id, held_ms)
+
+    def run(self):
+        interval = RFID_MIN_INTERVAL
+        while not self.isInterruptionRequested():
             try:
-                #a response looks like {0x00BB,1,0x0000,80;0x000000801CD1931B2F14}, we want the number stored in the last index
-                #more available at https://www.rfideas.com/sites/default/files/2020-01/ASCII_Manual.pdf
-                sanitized_data = re.sub("[{}\r\n]", "", line.decode())
-                card_info = sanitized_data.split(',')
-                #checks if the card has not been at the reader for more than 2 seconds and ignores if so
-                #divided by 48 because time is in intervals of 48ms
-                if int(card_info[0], 16) > (2000 / 48):
-                    time.sleep(0.5)
-                    continue
-                card_id_string = card_info[3].split(';')[1]
-                card_id = int(card_id_string, 16)
-                #0 means no card read, so ignore
-                if card_id == 0:
-                    time.sleep(0.5)
-                    continue
-                else:
-                    #at some point, this could be transitioned to the Requester class to make it follow after the similar system in the barcode scanner class
-                    #but for now, we'll just emit the user info after the card is read and info is pulled
-
-                    #emits tuple, (does user exist, user info)
-                    info = requests.get(SERVER_URL + "/user", params={"gtid": card_id})
-                    if info.status_code != 200:
-                        self.found.emit((False, {"gtid": card_id}))
-                    else:
-                        self.found.emit((True, info.json()))
-                    self.serial.close()
-            except:
+                if self.serial is None:
+                    self.open_port()
+
+                card = self.poll()
+            except (serial.SerialException, OSError) as e:
+                #the reader was unplugged or the port isn't there yet, try again in a second
+                print("RFID reader error: {}".format(e))
+                self.close_port()
+                time.sleep(1)
+                continue
+
+            if card is None:
+                #nobody around, back off
+                interval = min(interval * 2, RFID_MAX_INTERVAL)
+            else:
+                interval = RFID_MIN_INTERVAL
+                card_id, held_ms = card
+                now = time.monotonic()
+                is_repeat = card_id == self.last_card and now - self.last_card_time < RFID_REPEAT_DELAY
+                if held_ms <= RFID_MAX_HOLD and not is_repeat:
+                    self.last_card = card_id
+                    self.last_card_time = now
+                    self.found.emit(str(card_id))
+
+            time.sleep(interval)
+
+        self.close_port()
+
+    def close_port(self):
+        if self.serial is not None:
+            try:
+                self.serial.close()
+            except Exception:
                 pass
+            self.serial = None
 
-#This class is for the thread to make blocking HTTP requests to the server outside of the main thread
+    def stop(self):
+        self.requestInterruption()
+        self.wait()
+
+#This class makes blocking HTTP requests to the server outside of the main thread
 #It drastically improves UX and allows for loaders to be displayed while requesting data
-class Requester(QThread):
+#Requests run on the shared worker pool (see submit_request) instead of each getting their own thread
+class Requester(QObject):
     complete = Signal(req.Response)
 
     def __init__(self, e, method, path, **kwargs):
-        #e is a reference to the class this runs in, so we can set it as the parent of this thread
+        #e is a reference to the class this runs in, so we can set it as the parent of this object
         super().__init__(e)
 
         self.method = method
         self.path = path
 
         self.kwargs = kwargs
+        self.future = None
 
-    def run(self):
-        #gets the function to make the request (i.e. requests.get, requests.post, etc)
-        method = getattr(requests, self.method)
-        #and makes it with any args passed to the constructor
-        req = method(SERVER_URL + self.path, **self.kwargs)
-        self.complete.emit(req)
+    def start(self):
+        self.future = submit_request(self.method, self.path, **self.kwargs)
+        self.future.add_done_callback(self.on_done)
+
+    #runs on the worker thread, Qt hands the signal over to the UI thread
+    def on_done(self, future):
+        try:
+            self.complete.emit(future.result())
+        except RuntimeError:
+            #the screen that made this request was closed before it finished, so nobody is listening
+            pass
+
+    #blocks until the request is done
+    def wait(self):
+        if self.future is not None:
+            self.future.result()
 
 #main window, contains the stack of widgets controlled by ApplicationController
 class MainWindow(QMainWindow):
@@ -272,12 +783,13 @@ class StartScreen(QWidget):
         self.l.addStretch()
 
         #Before starting to scan for RFID cards, make sure we can talk to the server
-        #if not, throw an error and die
+        #if not, fall back to the local copy of the item list, or throw an error and die if there isn't one yet
         try:
-            if requests.get(SERVER_URL + "/ping").status_code == 200:
-                t = RfidController(self)
-                t.found.connect(self.next_page)
-                t.start()
+            if get_session().get(SERVER_URL + "/ping", timeout=REQUEST_TIMEOUT).status_code == 200:
+                #badge taps are handled by the controller (see ApplicationController.handle_card)
+                self.controller.get_rfid()
+                #freshen the local copy (and send anything left over from being offline) without waiting for the timer
+                self.controller.start_sync()
             else:
                 #can connect but auth failed
                 msg = QMessageBox(QMessageBox.Icon.Critical, "", "Error Authenticating with Server")
@@ -287,6 +799,13 @@ class StartScreen(QWidget):
                 msg.exec()
                 sys.exit(111)
         except Exception as e:
+            if local_store.has_items():
+                #can't connect, but we can keep going with what we have and catch up once the server is back
+                self.controller.online = False
+                subtext.setText("Scan ID to begin (offline)")
+                self.controller.get_rfid()
+                return
+
             #can't connect at all
             msg = QMessageBox(QMessageBox.Icon.Critical, "", "Error Contacting Server")
             msg.setInformativeText("Check that the server is on and running then press OK to restart the client")
@@ -295,16 +814,6 @@ class StartScreen(QWidget):
             msg.exec()
             sys.exit(111)
 
-    #handle the tuple emitted from RfidController by beginning the login process
-    #user_doc looks like (does user exist, user info)
-    def next_page(self, user_doc):
-        if user_doc[0] == False:
-            #doesn't exist, so show the create user screen and pass the GTID of the new user
-            self.controller.go_to_widget(NameScreen, user_doc[1]["gtid"])
-        else:
-            self.controller.set_user_info(user_doc[1])
-            self.controller.go_to_widget(MainScreen)
-
 #creates the buttons you see on the main screen with the large icons
 def build_large_action_button(text, image, action = None):
     button = QWidget()
@@ -437,25 +946,30 @@ class BaseTransactionScreen(QWidget):
         spread.addLayout(textArea)
         spread.addStretch()
         
-        #uses Requester to download image by ID included in the call to create_entry
+        #shows the image by ID included in the call to create_entry, from the cache if we've seen it before
+        #or by downloading it with Requester if not
         if image:
             img_label = QLabel()
             img_label.setAlignment(Qt.AlignHCenter)
             spread.addWidget(img_label)
 
-            #defines a function to add the image once the request finishes
-            #this is later passed into the Requester as a callback
-            def on_req_complete(img_label, downloaded_img):
-                icon = QPixmap()
-                icon.loadFromData(downloaded_img.content)
-                icon = icon.scaled(60, 60, Qt.KeepAspectRatio)
-                img_label.setPixmap(icon)
-
-            #all images in the system follow this pattern for access
-            req = Requester(self, "get", "/image/{}".format(image))
-            #use a partial to give the callback access to the label to hold the image
-            req.complete.connect(partial(on_req_complete, img_label))
-            req.start()
+            cached = image_cache.get(image)
+            if cached is not None:
+                img_label.setPixmap(cached)
+            else:
+                #defines a function to add the image once the request finishes
+                #this is later passed into the Requester as a callback
+                def on_req_complete(img_label, downloaded_img):
+                    if downloaded_img.status_code != 200:
+                        return
+                    img_label.setPixmap(image_cache.put(image, downloaded_img.content))
+
+                #all images in the system follow this pattern for access
+                #the server keeps a 60px copy of every image, so ask for that instead of scaling down the full size one
+                req = Requester(self, "get", "/image/{}".format(image), params={"size": THUMBNAIL_SIZE})
+                #use a partial to give the callback access to the label to hold the image
+                req.complete.connect(partial(on_req_complete, img_label))
+                req.start()
         #adds the side text only if no image exists
         else:
             spread.addWidget(QLabel(side_text)) if side_text != None else ""
@@ -538,8 +1052,15 @@ class NameScreen(BaseTransactionScreen):
         requester.start()
 
     #when the the server finishes creating the user, take the doc and save it to the local state
-    #the _ is to ignore the response data from the server, since it's not needed
-    def endRequest(self, new_user_dict, loader, _):
+    #if the server couldn't be reached, the user is created once it's back
+    #a user the server turned down (i.e. a duplicate email) isn't saved, or the badge would keep logging in offline
+    def endRequest(self, new_user_dict, loader, response):
+        if is_offline(response):
+            local_store.queue("post", "/user", new_user_dict)
+            local_store.save_user(new_user_dict)
+        elif response.status_code == 200:
+            new_user_dict["id"] = response.json()["id"]
+            local_store.save_user(new_user_dict)
         self.controller.set_user_info(new_user_dict)
         self.controller.go_to_widget(MainScreen)
         loader.close()
@@ -551,19 +1072,37 @@ class ItemsOutScreen(BaseTransactionScreen):
     def __init__(self, controller):
         super().__init__(controller, title_text="Your checked out items", empty_text="You have no items checked out")
         self.create_action_button("Main Menu", action=lambda: controller.go_to_widget(MainScreen))
-        
+
+        #already fetched at login
+        if controller.open_items is not None:
+            self.show_items(controller.open_items)
+            return
+
         self.load = LoadWindow()
         self.load.show()
-        request = Requester(self, "get", "/user/items", params={"gtid": self.controller.user_info["gtid"]})
-        request.complete.connect(self.getItemsCallback)
+        gtid = self.controller.user_info["gtid"]
+        request = Requester(self, "get", "/user/items", params={"gtid": gtid})
+        request.complete.connect(partial(self.getItemsCallback, gtid, controller.open_items_generation))
 
         request.start()
         
-    def getItemsCallback(self, items):
-        for item in items.json():
-            self.create_entry(item['name'], under_text="As of {}".format(item["start_date"]), side_text="Located at {}".format(item['area']) if item['area'] else "", image=item['image'])
+    def getItemsCallback(self, gtid, generation, items):
+        if items.status_code != 200:
+            self.create_heading("Your items can't be loaded right now")
+            self.load.close()
+            return
+
+        items = items.json()
+        #only kept for next time if it's still the same user and nothing was checked in or out while it was loading
+        if self.controller.user_info.get("gtid") == gtid and self.controller.open_items_generation == generation:
+            self.controller.open_items = items
+        self.show_items(items)
         self.load.close()
 
+    def show_items(self, items):
+        for item in items:
+            self.create_entry(item['name'], under_text="As of {}".format(item["start_date"]), side_text="Located at {}".format(item['area']) if item['area'] else "", image=item['image'])
+
 #this class is building on the BaseTransactionScreen to make the check in and out screens
 class BaseScanScreen(BaseTransactionScreen):
     should_refresh = True
@@ -579,30 +1118,43 @@ class BaseScanScreen(BaseTransactionScreen):
         self.current_items = []
         self.requests = []
         
-        #picks up incoming barcodes from the scanner
-        self.scanner = ScannerController(self)
+        #picks up incoming barcodes from the shared scanner
+        self.scanner = controller.get_scanner()
         self.scanner.item.connect(self.item_scanned)
-
-        self.scanner.start()
         
 
-    def item_scanned(self, barcode):
+    def item_scanned(self, barcode, read_at):
+        #most items are already in the local copy of the item list, so no need to ask the server
+        item = local_store.find_item(barcode)
+        if item is not None:
+            self.add_items([item])
+            self.scanner.metrics.record(read_at)
+            return
+
         requester = Requester(self, "get", "/item", params={"barcode": barcode})
 
         self.requests.append(requester)
 
         load = LoadWindow()
         load.show()
-        requester.complete.connect(partial(self.on_request_complete, requester, load))
+        requester.complete.connect(partial(self.on_request_complete, requester, load, read_at))
         requester.start()
 
-    def on_request_complete(self, requester, load_screen, b):
+    def on_request_complete(self, requester, load_screen, read_at, b):
         load_screen.close()
         self.requests.remove(requester)
+        self.scanner.metrics.record(read_at)
+
+        if b.status_code != 200:
+            return
 
         api_response = b.json()
-        #adds all items returned from the api response
-        for item in api_response:
+        local_store.save_items(api_response)
+        self.add_items(api_response)
+
+    #adds all items returned from the api response (or the local copy) to the list, skipping ones already in it
+    def add_items(self, items):
+        for item in items:
             if not next((el for el in self.current_items if el["id"] == item["id"]), False):
                 self.current_items.append(item)
                 self.create_entry(item["name"], under_text="Located in {}".format(item['area']) if item['area'] else "Barcode: {}".format(item["barcode"]), image=item['image'])
@@ -612,17 +1164,13 @@ class BaseScanScreen(BaseTransactionScreen):
         for req in self.requests:
             req.wait()
 
-        #close the scanner serial and kill the thread
-        #another sticeking point, this seems to cause problems especially when testing on Windows
-        self.scanner.serial.close()
-        self.scanner.quit()
+        #stop listening to the scanner, the scanner itself stays open for the next scan screen
+        self.scanner.item.disconnect(self.item_scanned)
+        print("Scan latency: {}".format(self.scanner.metrics.summary()))
 
     #when user finishes, call the request builder to build the request and send it to the server
     #then, display the results in a receipt screen
     def check_out_items(self):
-        error_items = []
-        success_items = []
-
         #error out if no items are scanned to check out/in
         if len(self.current_items) == 0:
             msg = QMessageBox(QMessageBox.Icon.Warning, "Invalid Request", "No items selected!")
@@ -635,48 +1183,73 @@ class BaseScanScreen(BaseTransactionScreen):
         self.load = LoadWindow()
         self.load.show()
 
-        #callback for requests when they finish
-        def checkout_request_done(self, requester, item, data):
+        #callback for the request when it finishes
+        def checkout_request_done(self, requester, items, data):
             self.requests.remove(requester)
-            
-            if data.status_code != 200:
-                item.update({"error": data.json()['error']})
-                error_items.append(item)
+            #the user's checked out items have changed, so ItemsOutScreen has to ask the server again
+            self.controller.forget_open_items()
+
+            error_items = []
+            success_items = []
+
+            if is_offline(data):
+                #the server couldn't be reached, so save the cart and send it once it's back
+                local_store.queue(requester.method, requester.path, requester.kwargs["json"])
+                self.controller.online = False
+                for item in items:
+                    item.update({"message": "Saved offline, will be sent when the server is back"})
+                    success_items.append(item)
+            elif data.status_code != 200:
+                #the whole cart failed (bad user, server error, no answer in time, etc) so every item gets the same error
+                #a cart that went unanswered isn't saved offline, since the server may have checked it out already
+                try:
+                    error = data.json()['error']
+                except Exception:
+                    error = "Error contacting server"
+                for item in items:
+                    item.update({"error": error})
+                    error_items.append(item)
             else:
-                if data.json().get("message", None):
-                    item.update({"message": data.json()['message']})
-                success_items.append(item)
+                #the server answers with one result per item, in the same order they were sent
+                for item, result in zip(items, data.json()):
+                    if "error" in result:
+                        item.update({"error": result['error']})
+                        error_items.append(item)
+                    else:
+                        if result.get("message", None):
+                            item.update({"message": result['message']})
+                        success_items.append(item)
 
-            #close the load screen if all requests are done, then go to the Receipt screen
-            if len(self.requests) == 0:
-                self.load.close()
-                self.controller.go_to_widget(TransactionCompleteScreen, error_items, success_items)
+            #close the load screen and go to the Receipt screen
+            self.load.close()
+            self.controller.go_to_widget(TransactionCompleteScreen, error_items, success_items)
 
-        #send a request from the builder for each item
+        #send the whole cart in a single request from the builder
         #NEEDS to be implemented in the subclass, this class does not work standalone
-        for item in self.current_items:
-            requester = self.request_builder(item)
-            self.requests.append(requester)
+        items = list(self.current_items)
+        requester = self.request_builder(items)
+        self.requests.append(requester)
 
-            requester.complete.connect(partial(checkout_request_done, self, requester, item))
+        requester.complete.connect(partial(checkout_request_done, self, requester, items))
 
-            requester.start()
+        requester.start()
 
 class ScanOutScreen(BaseScanScreen):
     def __init__(self, controller):
         super().__init__(controller, "Check out items", self.build_request)
 
-    #builds a requester object to check out an item when given the item object
-    def build_request(self, item):
-        return Requester(self, "post", "/checkout", json={"barcode": item["barcode"], "gtid": self.controller.user_info["gtid"]})
+    #builds a requester object to check out every item in the cart when given the item objects
+    def build_request(self, items):
+        #"at" keeps the original time if this ends up being sent later from the outbox
+        return Requester(self, "post", "/checkout/bulk", json={"barcodes": [item["barcode"] for item in items], "gtid": self.controller.user_info["gtid"], "at": datetime.now().isoformat()})
 
 class ScanInScreen(BaseScanScreen):
     def __init__(self, controller):
         super().__init__(controller, "Check in items", self.build_request)
 
-    #builds a requester object to check in an item when given the item object
-    def build_request(self, item):
-        return Requester(self, "delete", "/checkout", json={"barcode": item["barcode"], "gtid": self.controller.user_info["gtid"]})
+    #builds a requester object to check in every item in the cart when given the item objects
+    def build_request(self, items):
+        return Requester(self, "delete", "/checkout/bulk", json={"barcodes": [item["barcode"] for item in items], "gtid": self.controller.user_info["gtid"], "at": datetime.now().isoformat()})
 
 
 #shows a receipt screen when a transaction is complete
@@ -717,6 +1290,13 @@ class TimeoutKeyInterceptor(QObject):
 app = QApplication([])
 window = MainWindow()
 
+#QPixmaps can only be made once the QApplication exists
+image_cache = ImageCache(
+    os.path.expanduser(os.getenv("THUMBNAIL_CACHE_DIR") or "~/.cache/lmao/images"),
+    max_disk_bytes=int(os.getenv("THUMBNAIL_CACHE_BYTES") or 50 * 1024 * 1024),
+    max_memory_entries=int(os.getenv("THUMBNAIL_CACHE_ENTRIES") or 200)
+)
+
 
 window.show()
 
@@ -729,6 +1309,9 @@ controller = ApplicationController(window)
 tki = TimeoutKeyInterceptor(controller)
 window.installEventFilter(tki)
 
+#lets the scanner thread close its serial port before the app exits
+app.aboutToQuit.connect(controller.shut_down)
+
 window.stack.addWidget(StartScreen(controller))
 
 app.exec()
\ No newline at end of file
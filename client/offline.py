@@ -0,0 +1,136 @@
+import os
+import sqlite3
+import threading
+import json
+import time
+
+#Keeps a copy of the server's items and users in a local SQLite database,
+#so scans and badge taps can be looked up without a round trip, and the terminal keeps working when the server can't be reached.
+#Checkouts and returns made while offline are written to the outbox and sent to the server in order once it's back.
+#Anything the server turns down when the outbox is replayed is kept in the conflicts table (and printed to the log)
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    id TEXT PRIMARY KEY,
+    barcode TEXT UNIQUE,
+    name TEXT,
+    area INTEGER,
+    image TEXT,
+    description TEXT,
+    last_calibration TEXT
+);
+CREATE TABLE IF NOT EXISTS users (
+    gtid TEXT PRIMARY KEY,
+    id TEXT,
+    name TEXT,
+    email TEXT
+);
+CREATE TABLE IF NOT EXISTS outbox (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    method TEXT,
+    path TEXT,
+    body TEXT,
+    created REAL
+);
+CREATE TABLE IF NOT EXISTS conflicts (
+    seq INTEGER PRIMARY KEY,
+    method TEXT,
+    path TEXT,
+    body TEXT,
+    status INTEGER,
+    error TEXT,
+    created REAL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+ITEM_FIELDS = ["id", "barcode", "name", "area", "image", "description", "last_calibration"]
+USER_FIELDS = ["gtid", "id", "name", "email"]
+
+class LocalStore:
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        #used from the UI thread for lookups and from the request workers for syncing, so every use goes through the lock
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.executescript(SCHEMA)
+
+    def find_item(self, barcode):
+        with self.lock:
+            row = self.conn.execute("SELECT * FROM items WHERE barcode = ?", (barcode,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def find_user(self, gtid):
+        with self.lock:
+            row = self.conn.execute("SELECT * FROM users WHERE gtid = ?", (str(gtid),)).fetchone()
+        return dict(row) if row is not None else None
+
+    def has_items(self):
+        with self.lock:
+            return self.conn.execute("SELECT 1 FROM items LIMIT 1").fetchone() is not None
+
+    def save_items(self, items):
+        rows = [tuple(item.get(f) for f in ITEM_FIELDS) for item in items]
+        with self.lock, self.conn:
+            #a barcode may have moved to a different item, so clear it off the old one first
+            self.conn.executemany("DELETE FROM items WHERE barcode = ? AND id != ?", [(r[1], r[0]) for r in rows])
+            self.conn.executemany("INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def delete_items(self, ids):
+        with self.lock, self.conn:
+            self.conn.executemany("DELETE FROM items WHERE id = ?", [(i,) for i in ids])
+
+    def save_user(self, user):
+        self.save_users([user])
+
+    def save_users(self, users):
+        rows = [(str(user.get("gtid")), user.get("id"), user.get("name"), user.get("email")) for user in users]
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?)", rows)
+
+    #users are keyed by GTID locally, but deletions from the server come with the user's ID
+    def delete_users(self, ids):
+        with self.lock, self.conn:
+            self.conn.executemany("DELETE FROM users WHERE id = ?", [(i,) for i in ids])
+
+    #drops every row of a table whose ID isn't in ids, for when the server sends a full copy (see refresh_items)
+    def keep_only(self, table, ids):
+        ids = set(ids)
+        with self.lock, self.conn:
+            stale = [(i,) for (i,) in self.conn.execute("SELECT id FROM {}".format(table)) if i not in ids]
+            self.conn.executemany("DELETE FROM {} WHERE id = ?".format(table), stale)
+
+    #adds a request to the end of the outbox, to be sent once the server is reachable again
+    def queue(self, method, path, body):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT INTO outbox (method, path, body, created) VALUES (?, ?, ?, ?)", (method, path, json.dumps(body), time.time()))
+
+    def pending(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT * FROM outbox ORDER BY seq").fetchall()
+        return [dict(r, body=json.loads(r["body"])) for r in rows]
+
+    def pending_count(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    #removes a request from the outbox once the server has answered it, recording it as a conflict if it wasn't accepted
+    def finish(self, entry, status=200, error=None):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM outbox WHERE seq = ?", (entry["seq"],))
+            if error is not None:
+                self.conn.execute("INSERT OR REPLACE INTO conflicts VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                  (entry["seq"], entry["method"], entry["path"], json.dumps(entry["body"]), status, error, entry["created"]))
+
+    def get_meta(self, key, default=None):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row["value"] if row is not None else default
+
+    def set_meta(self, key, value):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
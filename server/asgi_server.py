@@ -0,0 +1,423 @@
+from os import getenv
+from datetime import datetime
+from types import SimpleNamespace
+import time
+import asyncpg
+import psycopg2
+from flask import json
+from peewee import Alias
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware.wsgi import WSGIMiddleware
+from starlette.responses import Response, HTMLResponse, FileResponse, StreamingResponse
+from starlette.routing import Route, Mount
+from lmao_server import create_app
+from models import db, gen_uuid, ApiKey, Checkout, Image, ImageVariant, Item, User
+from cache import key_cache, image_cache, image_key
+from storage import store, image_path, read_image
+from imaging import SIZES, FULL_SIZE, make_variant
+from events import EVENT_CHANNEL, event_payload
+from metrics import metrics, RequestStats
+from routes.item import build_item_query, MAX_PAGE_SIZE
+from routes.image import IMAGE_CACHE_CONTROL
+from routes.checkout import calibration_message
+from routes.user import LOGIN_SQL, login_response
+
+#An async entry point for the endpoints the Pis hit all day: /ping, /user, /user/login, /user/items, /item, /checkout and /image/<id>.
+#These run on one event loop with an asyncpg connection pool, so a shift change's worth of Pis waiting on Postgres or on
+#image transfers doesn't need a thread each. Everything else (the admin panel, uploads, bulk checkouts, /sync, /events,
+#reports, /metrics) is the usual Flask app from create_app, mounted underneath and run on threads as before.
+#Responses match the Flask routes, so clients can't tell which server they're talking to.
+#
+#   uvicorn --factory asgi_server:create_asgi_app --port 80
+#
+#The queries are still built with peewee so they stay the same as the Flask routes, asyncpg only runs them
+
+#connections in the asyncpg pool, these are separate from the peewee pool the mounted Flask app uses
+ASYNC_POSTGRES_MAX_CONNECTIONS = int(getenv('ASYNC_POSTGRES_MAX_CONNECTIONS') or 20)
+
+flask_app = None
+pool = None
+
+#turns a peewee query into SQL with asyncpg's $1 style placeholders, and the names its columns come back as with .dicts()
+def compile_query(query):
+    sql, params = query.sql()
+    parts = sql.split("%s")
+    sql = "".join(part + ("${}".format(i + 1) if i < len(parts) - 1 else "") for i, part in enumerate(parts))
+    return sql, [unwrap_param(p) for p in params]
+
+#peewee wraps BlobField values for psycopg2, which asyncpg can't send, so they go back to plain bytes
+def unwrap_param(param):
+    if isinstance(param, psycopg2.Binary):
+        return bytes(param.adapted)
+    return param
+
+def column_names(query):
+    return [c._alias if isinstance(c, Alias) else c.name for c in query.selected_columns]
+
+async def fetch_dicts(conn, query):
+    sql, params = compile_query(query)
+    names = column_names(query)
+    return [dict(zip(names, record.values())) for record in await conn.fetch(sql, *params)]
+
+async def fetch_dict(conn, query):
+    rows = await fetch_dicts(conn, query.limit(1))
+    return rows[0] if len(rows) > 0 else None
+
+async def execute(conn, query):
+    sql, params = compile_query(query)
+    return await conn.execute(sql, *params)
+
+#the same JSON as jsonify, so datetimes and key order come out exactly like the Flask routes
+def json_response(data, status_code=200, headers=None):
+    body = json.dumps(data, app=flask_app, separators=(",", ":")) + "\n"
+    return Response(body, status_code=status_code, headers=headers, media_type="application/json")
+
+def error_response(e):
+    return json_response({"error": str(e), "type": type(e).__name__}, 500)
+
+#same as auth_middleware, but the database is only asked on a cache miss and through asyncpg
+async def is_authorized(request):
+    code = request.headers.get('Authorization', "").replace("Bearer ", "")
+    if not code:
+        return False
+
+    valid = key_cache.cached(code)
+    if valid is None:
+        generation = key_cache.generation
+        async with pool.acquire() as conn:
+            valid = await fetch_dict(conn, ApiKey.select(ApiKey.id).where(ApiKey.code == code)) is not None
+        key_cache.remember(code, valid, generation)
+    return valid
+
+def authorized(endpoint):
+    async def wrapper(request):
+        if not await is_authorized(request):
+            return json_response({"error": "Client is unauthorized"}, 401)
+        return await endpoint(request)
+    wrapper.__name__ = endpoint.__name__
+    return wrapper
+
+@authorized
+async def ping(request):
+    return HTMLResponse("Pong")
+
+@authorized
+async def get_user(request):
+    try:
+        gtid = request.query_params['gtid']
+        async with pool.acquire() as conn:
+            user = await fetch_dict(conn, User.select().where(User.gtid == gtid))
+        if user is None:
+            return json_response({"error": "User does not exist"}, 404)
+        return json_response(user)
+    except KeyError:
+        return json_response({"error": "Missing GT id"}, 400)
+    except Exception as e:
+        return error_response(e)
+
+#asyncpg prepares and caches the statement per connection by itself, so this is the same as the Flask route
+@authorized
+async def login_user(request):
+    try:
+        gtid = request.query_params['gtid']
+        async with pool.acquire() as conn:
+            record = await conn.fetchrow(LOGIN_SQL, gtid)
+        if record is None:
+            return json_response({"error": "User does not exist"}, 404)
+        #asyncpg hands json columns back as text
+        *user, open_count, items = record.values()
+        return json_response(login_response([*user, open_count, json.loads(items)]))
+    except KeyError:
+        return json_response({"error": "Missing GT id"}, 400)
+    except Exception as e:
+        return error_response(e)
+
+@authorized
+async def get_user_items(request):
+    try:
+        gtid = request.query_params['gtid']
+        async with pool.acquire() as conn:
+            user = await fetch_dict(conn, User.select(User.id).where(User.gtid == gtid))
+            if user is None:
+                return json_response({"error": "User or checkout does not exist"}, 404)
+            open_checkouts = await fetch_dicts(conn, Checkout.select(
+                Checkout.start_date, Item.name, Item.barcode, Item.area, Item.image
+            ).where((Checkout.user_id == user['id']) & (Checkout.return_date.is_null())).join(Item))
+        return json_response(open_checkouts)
+    except KeyError:
+        return json_response({"error": "Missing GT id"}, 400)
+    except Exception as e:
+        return error_response(e)
+
+#same as stream_items in routes/item.py, but reading from an asyncpg cursor
+async def stream_items(sql, params, names, ndjson):
+    async with pool.acquire() as conn:
+        #asyncpg cursors only live inside a transaction
+        async with conn.transaction():
+            first = True
+            if not ndjson:
+                yield "["
+            async for record in conn.cursor(sql, *params, prefetch=100):
+                row = json.dumps(dict(zip(names, record.values())), app=flask_app)
+                if ndjson:
+                    yield row + "\n"
+                else:
+                    yield ("" if first else ",") + row
+                    first = False
+            if not ndjson:
+                yield "]"
+
+@authorized
+async def get_item(request):
+    args = request.query_params
+    try:
+        query = build_item_query(args)
+        limit = args.get('limit')
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE)) if limit is not None else None
+    except ValueError:
+        return json_response({"error": "area and limit must be numbers"}, 400)
+
+    ndjson = args.get('format') == 'ndjson'
+    media_type = 'application/x-ndjson' if ndjson else 'application/json'
+
+    if limit is not None:
+        async with pool.acquire() as conn:
+            rows = await fetch_dicts(conn, query.limit(limit + 1))
+        headers = {}
+        if len(rows) > limit:
+            rows = rows[:limit]
+            headers['X-Next-After'] = rows[-1]['id']
+        if ndjson:
+            body = "".join(json.dumps(row, app=flask_app) + "\n" for row in rows)
+        else:
+            body = "[" + ",".join(json.dumps(row, app=flask_app) for row in rows) + "]"
+        return Response(body, headers=headers, media_type=media_type)
+
+    sql, params = compile_query(query)
+    return StreamingResponse(stream_items(sql, params, column_names(query), ndjson), media_type=media_type)
+
+def publish_checkout(conn, type, checkout_id, item, user):
+    return conn.execute("SELECT pg_notify($1, $2)", EVENT_CHANNEL, event_payload(type, id=checkout_id,
+        item={"id": item['id'], "barcode": item['barcode'], "name": item['name']},
+        user={"id": user['id'], "gtid": user['gtid'], "name": user['name']}))
+
+#the same checks and answers as create_checkout in routes/checkout.py
+@authorized
+async def create_checkout(request):
+    try:
+        body = await request.json()
+        gtid, barcode = body['gtid'], body['barcode']
+        async with pool.acquire() as conn:
+            user = await fetch_dict(conn, User.select().where(User.gtid == gtid))
+            if user is None:
+                return json_response({"error": "User does not exist", "type": "UserDoesNotExist"}, 500)
+            item = await fetch_dict(conn, Item.select().where(Item.barcode == barcode))
+            if item is None:
+                return json_response({"error": "Item does not exist", "type": "ItemDoesNotExist"}, 500)
+
+            owner = await fetch_dict(conn, Checkout.select(User.name).join(User).where(
+                (Checkout.item_id == item['id']) & (Checkout.return_date.is_null())
+            ))
+            if owner is not None:
+                return json_response({"error": "This item is already checked out by {}".format(owner['name'])}, 403)
+
+            checkout_id = gen_uuid()
+            now = datetime.now()
+            try:
+                async with conn.transaction():
+                    await execute(conn, Checkout.insert(id=checkout_id, start_date=now, updated_at=now, item_id=item['id'], user_id=user['id']))
+                    await publish_checkout(conn, "checkout", checkout_id, item, user)
+            except asyncpg.UniqueViolationError:
+                #another terminal checked it out between the lookup above and now (see checkouts_open_item_id)
+                return json_response({"error": "This item was just checked out at another terminal"}, 403)
+
+        message = calibration_message(item['last_calibration'])
+        if message is not None:
+            return json_response({"id": checkout_id, "message": message})
+        return json_response({"id": checkout_id})
+    except (KeyError, TypeError):
+        return json_response({"error": "Missing required information to check out this item"}, 400)
+    except Exception as e:
+        return error_response(e)
+
+#the same checks and answers as delete_checkout in routes/checkout.py
+@authorized
+async def delete_checkout(request):
+    try:
+        body = await request.json()
+        barcode = body['barcode']
+        async with pool.acquire() as conn:
+            ended = await fetch_dict(conn, Checkout.select(
+                Checkout.id, Item.id.alias('item_id'), Item.barcode, Item.name.alias('item_name'),
+                User.id.alias('user_id'), User.gtid, User.name.alias('user_name')
+            ).join(Item).switch(Checkout).join(User).where(
+                (Item.barcode == barcode) & (Checkout.return_date.is_null())
+            ))
+            if ended is None:
+                return json_response({"error": "This item is already checked back in"}, 400)
+
+            now = datetime.now()
+            item = {"id": ended['item_id'], "barcode": ended['barcode'], "name": ended['item_name']}
+            user = {"id": ended['user_id'], "gtid": ended['gtid'], "name": ended['user_name']}
+            async with conn.transaction():
+                await execute(conn, Checkout.update(return_date=now, updated_at=now).where(Checkout.id == ended['id']))
+                await publish_checkout(conn, "return", ended['id'], item, user)
+
+        if not ended['gtid'] == str(body['gtid']):
+            return json_response({"id": ended['id'], "message": "This item is returned for {}".format(ended['user_name'])})
+        return json_response({"id": ended['id']})
+    except (KeyError, TypeError):
+        return json_response({"error": "Missing required information to check out this item"}, 400)
+    except Exception as e:
+        return error_response(e)
+
+def image_response(key, data=None, path=None):
+    headers = {"ETag": '"{}"'.format(key), "Cache-Control": IMAGE_CACHE_CONTROL}
+    if path is not None:
+        return FileResponse(path, media_type='image/jpeg', headers=headers)
+    return Response(data, media_type='image/jpeg', headers=headers)
+
+#finds the row holding an image at the given size, making smaller sizes of older images the first time they're asked for
+#(the same as get_sized_row in routes/image.py). Returns None if there's no such image, or "processing" if it isn't ready
+async def get_sized_row(conn, id, size):
+    if size == FULL_SIZE:
+        image = await fetch_dict(conn, Image.select(Image.image, Image.digest, Image.status).where(Image.id == id))
+        if image is not None and image['status'] != "ready":
+            return "processing"
+        return image
+
+    variant = await fetch_dict(conn, ImageVariant.select(ImageVariant.image, ImageVariant.digest).where(
+        (ImageVariant.image_id == id) & (ImageVariant.size == size)
+    ))
+    if variant is not None:
+        return variant
+
+    original = await fetch_dict(conn, Image.select(Image.image, Image.digest, Image.status).where(Image.id == id))
+    if original is None:
+        return None
+    if original['status'] != "ready":
+        return "processing"
+
+    #resizing holds the GIL for a while, so it's done on a thread instead of on the event loop
+    variant = SimpleNamespace(image=None, digest=None)
+    data = await run_in_threadpool(read_image, SimpleNamespace(**original))
+    await run_in_threadpool(store.write, variant, await run_in_threadpool(make_variant, data, size))
+    #another request may have made the same size at the same time, which is fine since they're identical
+    await execute(conn, ImageVariant.insert(id=gen_uuid(), image_id=id, size=size, image=variant.image, digest=variant.digest).on_conflict_ignore())
+    return {"image": variant.image, "digest": variant.digest}
+
+async def get_image(request):
+    id = request.path_params['id']
+    try:
+        size = int(request.query_params.get('size', FULL_SIZE))
+    except ValueError:
+        size = FULL_SIZE
+    if size not in SIZES:
+        return json_response({"error": "Size must be one of {}".format(", ".join(str(s) for s in sorted(SIZES)))}, 400)
+
+    key = image_key(id, size)
+
+    try:
+        #same as the Flask route, a deleted image gets a 404 even if the client still has it
+        if '"{}"'.format(key) in request.headers.get('If-None-Match', "") or request.headers.get('If-None-Match') == "*":
+            async with pool.acquire() as conn:
+                image = await fetch_dict(conn, Image.select(Image.status).where(Image.id == id))
+            if image is None:
+                return json_response({"error": "Image does not exist"}, 404)
+            if image['status'] != "ready":
+                return json_response({"error": "Image is still being processed"}, 404)
+            return Response(status_code=304, headers={"ETag": '"{}"'.format(key), "Cache-Control": IMAGE_CACHE_CONTROL})
+
+        data = image_cache.get(key)
+        if data is None:
+            async with pool.acquire() as conn:
+                row = await get_sized_row(conn, id, size)
+            if row is None:
+                return json_response({"error": "Image does not exist"}, 404)
+            if row == "processing":
+                return json_response({"error": "Image is still being processed"}, 404)
+
+            path = image_path(SimpleNamespace(**row))
+            if path is not None:
+                return image_response(key, path=path)
+
+            data = bytes(row['image'])
+            image_cache.put(key, data)
+
+        return image_response(key, data=data)
+    except Exception as e:
+        return error_response(e)
+
+#counts the async routes in the same /metrics as the Flask ones. Queries made through asyncpg aren't counted
+class MetricsMiddleware():
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        stats = RequestStats()
+        status = [500]
+
+        async def send_and_record(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_and_record)
+        finally:
+            #requests for the mounted Flask app are already counted by its own middleware
+            route = scope.get("route_path")
+            if route is not None:
+                metrics.record_request(scope["method"], route, status[0], time.perf_counter() - stats.started, stats)
+
+#tags the scope with the route pattern for MetricsMiddleware, i.e. /image/{id} is reported as /image/<id> like Flask does
+def async_route(path, endpoint, methods):
+    flask_path = path.replace("{", "<").replace("}", ">")
+
+    async def tagged(request):
+        request.scope["route_path"] = flask_path
+        return await endpoint(request)
+    return Route(path, tagged, methods=methods)
+
+async def open_pool():
+    global pool
+    pool = await asyncpg.create_pool(
+        database=db.database,
+        user=db.connect_params.get('user'),
+        password=db.connect_params.get('password'),
+        host=db.connect_params.get('host'),
+        port=int(db.connect_params.get('port') or 5432),
+        min_size=1,
+        max_size=ASYNC_POSTGRES_MAX_CONNECTIONS
+    )
+
+async def close_pool():
+    await pool.close()
+
+def create_asgi_app():
+    global flask_app
+    #sets up the schema, the API key and the background jobs exactly like the WSGI server
+    flask_app = create_app()
+
+    flask_wsgi = WSGIMiddleware(flask_app)
+    routes = [
+        #would otherwise be taken for an image ID
+        Route('/image/cache', flask_wsgi),
+        async_route('/ping', ping, ['GET']),
+        async_route('/user', get_user, ['GET']),
+        async_route('/user/login', login_user, ['GET']),
+        async_route('/user/items', get_user_items, ['GET']),
+        async_route('/item', get_item, ['GET']),
+        async_route('/checkout', create_checkout, ['POST']),
+        async_route('/checkout', delete_checkout, ['DELETE']),
+        async_route('/image/{id}', get_image, ['GET']),
+        #anything not matched above (including other methods on the same paths) goes to Flask
+        Mount('/', app=flask_wsgi),
+    ]
+
+    app = Starlette(routes=routes, on_startup=[open_pool], on_shutdown=[close_pool])
+    return MetricsMiddleware(app)
@@ -0,0 +1,337 @@
+import argparse
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+import psycopg2
+import requests
+
+#Load test for the server. Starts the app from create_app() in this process against a throwaway database,
+#fills it with a realistic amount of data and then hammers it from several threads with a mix of what the Pis do
+#all day. Prints p50/p95/p99 latency and throughput for each endpoint and saves them as JSON so runs can be compared.
+#
+#   python bench.py                            throwaway database on the Postgres from POSTGRES_USER/PASSWORD/HOST
+#   python bench.py --database lmao_bench      use (and keep) this database instead, data is only seeded if it's empty
+#   python bench.py --compare bench-results/<earlier run>.json
+#
+#Run it from ./server like migrate.py. It needs the same environment variables as run.bat, and ideally nothing else
+#running against that Postgres while it goes
+
+#(endpoint, share of the requests sent), a checkout is always followed by returning the same item
+WORKLOAD = [
+    ("GET /user", 0.25),
+    ("GET /user/login", 0.10),
+    ("GET /item", 0.30),
+    ("POST+DELETE /checkout", 0.15),
+    ("GET /user/items", 0.10),
+    ("GET /image/<id>", 0.10),
+]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load test the LMAO server")
+    parser.add_argument("--database", help="database to run against instead of a throwaway one, it's kept afterwards")
+    parser.add_argument("--items", type=int, default=5000)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--checkouts", type=int, default=50000, help="returned checkouts to seed as history")
+    parser.add_argument("--images", type=int, default=100)
+    parser.add_argument("--clients", type=int, default=8, help="threads sending requests at once")
+    parser.add_argument("--threads", type=int, default=16, help="waitress threads, same as run.bat")
+    parser.add_argument("--warmup", type=float, default=5, help="seconds to run before measuring")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to measure for")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="where to save the results, defaults to bench-results/<time>.json")
+    parser.add_argument("--compare", help="results from an earlier run to compare against")
+    return parser.parse_args()
+
+#CREATE/DROP DATABASE can't run in a transaction, so these go over their own autocommit connection
+def run_admin_sql(sql):
+    conn = psycopg2.connect(dbname="postgres", user=os.getenv('POSTGRES_USER'), password=os.getenv('POSTGRES_PASSWORD'),
+                            host=os.getenv('POSTGRES_HOST'), port=os.getenv('POSTGRES_PORT') or 5432)
+    try:
+        conn.autocommit = True
+        conn.cursor().execute(sql)
+    finally:
+        conn.close()
+
+#fills the database in batches with insert_many, going through the models so the schema always matches
+def seed(args, rng):
+    from models import db, Item, User, Checkout, Image, ImageVariant, ApiKey, gen_uuid
+    from imaging import FULL_SIZE, process_upload
+    from storage import store
+    from PIL import Image as PILImage
+
+    key = ApiKey.create()
+    if Item.select().exists():
+        print("Database already has data, not seeding it")
+        return key.code
+
+    print("Seeding {} images".format(args.images))
+    image_ids = []
+    for _ in range(args.images):
+        picture = PILImage.new("RGB", (800, 600), tuple(rng.randrange(256) for _ in range(3)))
+        buffer = io.BytesIO()
+        picture.save(buffer, format="JPEG")
+
+        with db.atomic():
+            image = Image(status="ready")
+            encoded = process_upload(buffer.getvalue())
+            store.write(image, encoded[FULL_SIZE])
+            image.save(force_insert=True)
+            for size, data in encoded.items():
+                if size != FULL_SIZE:
+                    variant = ImageVariant(image_id=image, size=size)
+                    store.write(variant, data)
+                    variant.save(force_insert=True)
+        image_ids.append(image.id)
+
+    print("Seeding {} items and {} users".format(args.items, args.users))
+    now = datetime.now()
+    items = [{
+        "id": gen_uuid(),
+        "barcode": str(100000000 + i),
+        "name": "Item {}".format(i),
+        "area": rng.randrange(1, 20),
+        "image": rng.choice(image_ids) if image_ids and rng.random() < 0.5 else None,
+        "description": "Benchmark item {}".format(i),
+        "last_calibration": now - timedelta(days=rng.randrange(0, 500)),
+    } for i in range(args.items)]
+    users = [{
+        "id": gen_uuid(),
+        "gtid": str(900000000 + i),
+        "name": "User {}".format(i),
+        "email": "user{}@example.com".format(i),
+    } for i in range(args.users)]
+
+    with db.atomic():
+        for start in range(0, len(items), 1000):
+            Item.insert_many(items[start:start + 1000]).execute()
+        for start in range(0, len(users), 1000):
+            User.insert_many(users[start:start + 1000]).execute()
+
+    print("Seeding {} checkouts".format(args.checkouts))
+    with db.atomic():
+        batch = []
+        for _ in range(args.checkouts):
+            start_date = now - timedelta(days=rng.uniform(1, 730))
+            batch.append({
+                "id": gen_uuid(),
+                "start_date": start_date,
+                "return_date": start_date + timedelta(hours=rng.uniform(1, 24 * 30)),
+                "item_id": rng.choice(items)["id"],
+                "user_id": rng.choice(users)["id"],
+            })
+            if len(batch) == 1000:
+                Checkout.insert_many(batch).execute()
+                batch = []
+        if batch:
+            Checkout.insert_many(batch).execute()
+
+        #a few items are out at any time, like in the lab
+        open_items = items[:len(items) // 20]
+        Checkout.insert_many([{
+            "id": gen_uuid(),
+            "start_date": now - timedelta(days=rng.uniform(0, 30)),
+            "item_id": item["id"],
+            "user_id": rng.choice(users)["id"],
+        } for item in open_items]).execute()
+
+    return key.code
+
+#everything a client needs to pick realistic requests
+class Fixtures():
+    def __init__(self):
+        from models import Item, User, Image, Checkout
+
+        self.gtids = [u for (u,) in User.select(User.gtid).tuples()]
+        self.barcodes = [b for (b,) in Item.select(Item.barcode).tuples()]
+        self.images = [i for (i,) in Image.select(Image.id).tuples()]
+        open_items = Checkout.select(Checkout.item_id).where(Checkout.return_date.is_null())
+        #items that are in, only these are checked out and returned by the clients
+        self.free = [b for (b,) in Item.select(Item.barcode).where(Item.id.not_in(open_items)).tuples()]
+
+class Recorder():
+    def __init__(self):
+        self.lock = threading.Lock()
+        #endpoint -> list of seconds
+        self.latencies = {}
+        #endpoint -> {status: count}
+        self.statuses = {}
+        self.measuring = False
+
+    def record(self, endpoint, seconds, status):
+        if not self.measuring:
+            return
+        with self.lock:
+            self.latencies.setdefault(endpoint, []).append(seconds)
+            counts = self.statuses.setdefault(endpoint, {})
+            counts[status] = counts.get(status, 0) + 1
+
+def timed_request(recorder, session, endpoint, method, url, **kwargs):
+    started = time.perf_counter()
+    try:
+        response = session.request(method, url, timeout=30, **kwargs)
+        response.content
+        status = response.status_code
+    except requests.RequestException:
+        status = "error"
+    recorder.record(endpoint, time.perf_counter() - started, status)
+    return status
+
+#one simulated terminal. Each client checks out only its own share of the free items so clients never fight over one
+def client(index, args, base_url, key, fixtures, recorder, stop):
+    rng = random.Random(args.seed + index)
+    session = requests.Session()
+    session.headers["Authorization"] = "Bearer {}".format(key)
+    own_items = fixtures.free[index::args.clients]
+    endpoints = [e for e, _ in WORKLOAD]
+    weights = [w for _, w in WORKLOAD]
+
+    while not stop.is_set():
+        endpoint = rng.choices(endpoints, weights)[0]
+        gtid = rng.choice(fixtures.gtids)
+
+        if endpoint == "GET /user":
+            timed_request(recorder, session, endpoint, "GET", base_url + "/user", params={"gtid": gtid})
+        elif endpoint == "GET /item":
+            timed_request(recorder, session, endpoint, "GET", base_url + "/item", params={"barcode": rng.choice(fixtures.barcodes)})
+        elif endpoint == "GET /user/login":
+            timed_request(recorder, session, endpoint, "GET", base_url + "/user/login", params={"gtid": gtid})
+        elif endpoint == "GET /user/items":
+            timed_request(recorder, session, endpoint, "GET", base_url + "/user/items", params={"gtid": gtid})
+        elif endpoint == "GET /image/<id>" and fixtures.images:
+            timed_request(recorder, session, endpoint, "GET", base_url + "/image/{}".format(rng.choice(fixtures.images)), params={"size": 60})
+        elif endpoint == "POST+DELETE /checkout" and own_items:
+            body = {"gtid": gtid, "barcode": rng.choice(own_items)}
+            timed_request(recorder, session, "POST /checkout", "POST", base_url + "/checkout", json=body)
+            timed_request(recorder, session, "DELETE /checkout", "DELETE", base_url + "/checkout", json=body)
+
+def percentile(ordered, p):
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+def summarize(recorder, duration):
+    results = {}
+    for endpoint, latencies in sorted(recorder.latencies.items()):
+        ordered = sorted(latencies)
+        statuses = recorder.statuses[endpoint]
+        results[endpoint] = {
+            "requests": len(ordered),
+            "throughput": len(ordered) / duration,
+            "p50_ms": percentile(ordered, 50) * 1000,
+            "p95_ms": percentile(ordered, 95) * 1000,
+            "p99_ms": percentile(ordered, 99) * 1000,
+            "max_ms": ordered[-1] * 1000,
+            "statuses": {str(s): c for s, c in statuses.items()},
+        }
+    return results
+
+def print_results(results, previous=None):
+    print("{:<20} {:>8} {:>9} {:>9} {:>9} {:>9}  {}".format("endpoint", "req/s", "p50 ms", "p95 ms", "p99 ms", "max ms", "statuses"))
+    for endpoint, r in results.items():
+        print("{:<20} {:>8.1f} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f}  {}".format(
+            endpoint, r["throughput"], r["p50_ms"], r["p95_ms"], r["p99_ms"], r["max_ms"], r["statuses"]))
+        old = (previous or {}).get(endpoint)
+        if old is not None:
+            print("{:<20} {:>+7.0f}% {:>+8.0f}% {:>+8.0f}% {:>+8.0f}%".format(
+                "  vs previous", *[100 * (r[k] - old[k]) / old[k] if old[k] else 0 for k in ["throughput", "p50_ms", "p95_ms", "p99_ms"]]))
+
+#main() moves into a temporary directory, so git is pointed back at the repository this script is in
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except Exception:
+        return None
+
+def main():
+    args = parse_args()
+    rng = random.Random(args.seed)
+
+    throwaway = args.database is None
+    database = args.database or "lmao_bench_{}".format(uuid.uuid4().hex[:8])
+    if throwaway:
+        run_admin_sql('CREATE DATABASE "{}"'.format(database))
+    #paths are resolved now, before moving into a temporary directory below
+    output = os.path.abspath(args.output or os.path.join("bench-results", "{}.json".format(datetime.now().strftime("%Y%m%d-%H%M%S"))))
+    compare = os.path.abspath(args.compare) if args.compare else None
+
+    #has to be set before the server modules are imported, since they read it when they load
+    os.environ['POSTGRES_DB'] = database
+    os.environ.setdefault('IMAGE_STORE_PATH', tempfile.mkdtemp(prefix="lmao-bench-images-"))
+    #keeps the background jobs from competing with the measured requests
+    os.environ.setdefault('REPORT_REFRESH_INTERVAL', '0')
+    os.environ.setdefault('DUE_SCAN_INTERVAL', '0')
+    os.environ.setdefault('IMAGE_CACHE_WARM', '0')
+    os.environ.setdefault('TOMBSTONE_PRUNE_INTERVAL', '0')
+    os.environ.setdefault('POSTGRES_MAX_CONNECTIONS', str(args.threads + 4))
+    #create_app writes a first API key to ./key on an empty database, keep that out of ./server
+    os.chdir(tempfile.mkdtemp(prefix="lmao-bench-"))
+
+    server = None
+    try:
+        from waitress import create_server
+        from lmao_server import create_app
+        from models import db
+
+        app = create_app()
+        with db.connection_context():
+            key = seed(args, rng)
+            fixtures = Fixtures()
+
+        server = create_server(app, host="127.0.0.1", port=0, threads=args.threads)
+        threading.Thread(target=server.run, daemon=True).start()
+        base_url = "http://127.0.0.1:{}".format(server.effective_port)
+
+        recorder = Recorder()
+        stop = threading.Event()
+        clients = [threading.Thread(target=client, args=(i, args, base_url, key, fixtures, recorder, stop), daemon=True)
+                   for i in range(args.clients)]
+        for c in clients:
+            c.start()
+
+        print("Warming up for {}s".format(args.warmup))
+        time.sleep(args.warmup)
+        recorder.measuring = True
+        print("Measuring for {}s with {} clients".format(args.duration, args.clients))
+        time.sleep(args.duration)
+        recorder.measuring = False
+        stop.set()
+        for c in clients:
+            c.join()
+
+        results = {
+            "started": datetime.now().isoformat(),
+            "commit": git_commit(),
+            "config": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+            "endpoints": summarize(recorder, args.duration),
+        }
+
+        previous = None
+        if compare:
+            with open(compare) as f:
+                previous = json.load(f)["endpoints"]
+        print_results(results["endpoints"], previous)
+
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+        print("Saved results to {}".format(output))
+    finally:
+        if server is not None:
+            server.close()
+        if throwaway:
+            from models import db
+            from events import event_hub
+            #Postgres won't drop a database anything is still connected to, including the event listener
+            event_hub.stop()
+            db.close_all()
+            run_admin_sql('DROP DATABASE IF EXISTS "{}"'.format(database))
+
+if __name__ == "__main__":
+    sys.exit(main())
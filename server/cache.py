@@ -0,0 +1,166 @@
+from os import getenv
+from collections import OrderedDict
+from threading import Lock
+import time
+from models import db, ApiKey, Image, ImageVariant, Item
+from imaging import SIZES, FULL_SIZE
+
+#caches the result of API key lookups so every authenticated request doesn't cost a trip to Postgres
+#valid keys are kept for KEY_CACHE_TTL seconds, unknown keys for KEY_CACHE_NEGATIVE_TTL seconds
+#revoking or editing a key in the admin panel invalidates the cache straight away (see ApiAdmin)
+class KeyCache():
+    def __init__(self, ttl, negative_ttl, max_entries):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        #maps key code -> (is valid, expiry time)
+        self.entries = {}
+        #bumped by every invalidate, so a lookup that was already running when a key was revoked doesn't cache the old answer
+        self.generation = 0
+        self.lock = Lock()
+
+    def is_valid(self, code):
+        #empty headers/cookies can never match a key, so don't bother asking the database
+        if not code:
+            return False
+
+        valid = self.cached(code)
+        if valid is None:
+            generation = self.generation
+            valid = ApiKey.select().where(ApiKey.code == code).exists()
+            self.remember(code, valid, generation)
+        return valid
+
+    #whether a key is valid if that's still cached, otherwise None
+    #is_valid is built out of this and remember so the async server can look keys up with its own driver (see asgi_server.py)
+    #read generation before looking a key up and pass it to remember
+    def cached(self, code):
+        with self.lock:
+            entry = self.entries.get(code)
+        if entry is not None and entry[1] > time.monotonic():
+            return entry[0]
+        return None
+
+    #the answer is thrown away if the cache was invalidated since generation was read
+    def remember(self, code, valid, generation):
+        with self.lock:
+            if generation != self.generation:
+                return
+            #garbage tokens are cached too, so cap the size of the cache to stop them from eating memory
+            #dicts keep insertion order, so the first key is always the oldest entry
+            if code not in self.entries and len(self.entries) >= self.max_entries:
+                del self.entries[next(iter(self.entries))]
+            self.entries[code] = (valid, time.monotonic() + (self.ttl if valid else self.negative_ttl))
+
+    #drops a single key from the cache, or everything if no key is given
+    def invalidate(self, code=None):
+        with self.lock:
+            self.generation += 1
+            if code is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(code, None)
+
+key_cache = KeyCache(
+    ttl=int(getenv('KEY_CACHE_TTL') or 300),
+    negative_ttl=int(getenv('KEY_CACHE_NEGATIVE_TTL') or 30),
+    max_entries=int(getenv('KEY_CACHE_MAX_ENTRIES') or 10000)
+)
+
+#keeps the encoded JPEG bytes of recently used images in memory so /image/<id> doesn't have to pull them out of Postgres
+#entries are evicted least recently used first once the total size goes over max_bytes
+class ImageCache():
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        #maps image id -> bytes, ordered from least to most recently used
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = Lock()
+
+    def get(self, id):
+        with self.lock:
+            data = self.entries.get(id)
+            if data is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(id)
+            self.hits += 1
+            return data
+
+    def put(self, id, data):
+        #anything bigger than the whole budget would just push everything else out
+        if len(data) > self.max_bytes:
+            return
+
+        with self.lock:
+            if id in self.entries:
+                self.size -= len(self.entries[id])
+            self.entries[id] = data
+            self.entries.move_to_end(id)
+            self.size += len(data)
+
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    #drops every size of an image, i.e. after it was deleted
+    def invalidate(self, id):
+        with self.lock:
+            for size in SIZES:
+                data = self.entries.pop(image_key(id, size), None)
+                if data is not None:
+                    self.size -= len(data)
+
+    def has_room_for(self, nbytes):
+        return self.size + nbytes <= self.max_bytes
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
+
+image_cache = ImageCache(max_bytes=int(getenv('IMAGE_CACHE_BYTES') or 64 * 1024 * 1024))
+
+#the key used for both the image cache and the ETag, the full size keeps the plain ID so existing client caches stay valid
+def image_key(id, size):
+    return id if size == FULL_SIZE else "{}-{}".format(id, size)
+
+#(image id, blob) for every database-stored copy of the given images at one size
+#images on disk are served with sendfile and never go through the cache, so they're skipped
+def stored_blobs(ids, size):
+    if size == FULL_SIZE:
+        return Image.select(Image.id, Image.image).where(Image.id.in_(ids) & Image.digest.is_null()).tuples()
+    return ImageVariant.select(ImageVariant.image_id, ImageVariant.image).where(
+        ImageVariant.image_id.in_(ids) & (ImageVariant.size == size) & ImageVariant.digest.is_null()
+    ).tuples()
+
+#loads the database-stored images that are attached to items into the cache, since those are the ones the Pis and admin panel ask for
+#smallest sizes go first since those are what the lists show. Stops once the cache is full
+#meant to be run on a background thread when the server starts
+def warm_image_cache(batch_size=50):
+    with db.connection_context():
+        ids = [i['image'] for i in Item.select(Item.image).where(Item.image.is_null(False)).distinct().dicts()]
+
+        for size in sorted(SIZES):
+            #blobs are fetched a batch at a time so the whole table is never held in memory at once
+            for start in range(0, len(ids), batch_size):
+                for id, blob in stored_blobs(ids[start:start + batch_size], size):
+                    data = bytes(blob)
+                    if not image_cache.has_room_for(len(data)):
+                        return
+                    image_cache.put(image_key(id, size), data)
@@ -0,0 +1,179 @@
+from os import getenv
+from collections import deque
+from threading import Thread, Condition, BoundedSemaphore, Event
+from datetime import datetime
+import json
+import os
+import select
+import uuid
+import psycopg2
+from models import db
+from cache import key_cache, image_cache
+
+#Checkouts, returns and changes to items and users are published as events with Postgres NOTIFY,
+#so every server process connected to the database hears about them no matter which one handled the request.
+#Each process keeps one extra connection LISTENing on the channel and holds the last few events in memory
+#for the /events stream and long-poll endpoints to hand out (see routes/events.py).
+#The same connection also listens for cache invalidations (see CACHE_CHANNEL)
+EVENT_CHANNEL = "lmao_events"
+
+#sends an event to every server process. NOTIFY waits for the surrounding transaction,
+#so events published inside db.atomic() only go out if it commits
+def publish(type, **data):
+    db.execute_sql("SELECT pg_notify(%s, %s)", (EVENT_CHANNEL, event_payload(type, **data)))
+
+#sends several events in one query, so bulk routes don't pay a round trip for each one. Takes event_payload()s
+def publish_all(payloads):
+    if len(payloads) > 0:
+        db.execute_sql("SELECT pg_notify(%s, payload) FROM unnest(%s::text[]) AS payload", (EVENT_CHANNEL, payloads))
+
+def event_payload(type, **data):
+    data["type"] = type
+    data["at"] = datetime.now().isoformat()
+    return json.dumps(data, default=str)
+
+#Every server process keeps its own caches (see cache.py), so a change made through one process is broadcast
+#on this channel for the others to drop what they have cached. Keys are the code of an API key or the ID of an image,
+#None drops the whole cache
+CACHE_CHANNEL = "lmao_cache"
+CACHES = {
+    "keys": key_cache.invalidate,
+    "images": lambda id: image_cache.invalidate(id) if id is not None else image_cache.clear(),
+}
+
+#drops an entry from a cache in this process straight away and in every other process once the transaction commits
+def invalidate_everywhere(cache, key=None):
+    CACHES[cache](key)
+    db.execute_sql("SELECT pg_notify(%s, %s)", (CACHE_CHANNEL, json.dumps({"cache": cache, "key": key})))
+
+def checkout_event(type, checkout, item, user):
+    publish_all([checkout_payload(type, checkout, item, user)])
+
+def checkout_payload(type, checkout, item, user):
+    return event_payload(type, id=checkout.id,
+                         item={"id": item.id, "barcode": item.barcode, "name": item.name},
+                         user={"id": user.id, "gtid": user.gtid, "name": user.name})
+
+def item_event(item, deleted=False):
+    publish("item", id=item.id, barcode=item.barcode, name=item.name, deleted=deleted)
+
+def user_event(user, deleted=False):
+    publish("user", id=user.id, gtid=user.gtid, name=user.name, deleted=deleted)
+
+#the events this process has heard, numbered in the order they arrived
+#cursors look like "<process>-<number>" since the numbers only mean something to the process that handed them out.
+#A cursor from another process (or from before a restart), or one so old its events have been dropped, gets a "reset" event
+#telling the client it may have missed something and should reload whatever it's showing
+class EventHub():
+    def __init__(self, backlog, max_listeners):
+        self.events = deque(maxlen=backlog)
+        self.seq = 0
+        self.process = uuid.uuid4().hex[:8]
+        self.condition = Condition()
+        self.thread = None
+        #set by stop(), the pipe wakes the thread up if it's waiting on the connection
+        self.stopping = Event()
+        self.wake = None
+        #every listener ties up a waitress thread for as long as it waits, so only this many are let in at once
+        self.listeners = BoundedSemaphore(max_listeners)
+
+    #the LISTEN thread is started by create_app (and on first use) so importing this module (i.e. from migrate.py) doesn't open a connection
+    def start(self):
+        with self.condition:
+            if self.thread is None:
+                self.stopping.clear()
+                self.wake = os.pipe()
+                self.thread = Thread(target=self.listen, daemon=True)
+                self.thread.start()
+
+    #closes the LISTEN connection and waits for the thread to finish. Only needed when the database has to be
+    #let go of before the process exits, i.e. so bench.py can drop its throwaway database
+    def stop(self):
+        with self.condition:
+            thread, self.thread = self.thread, None
+        if thread is None:
+            return
+        self.stopping.set()
+        os.write(self.wake[1], b"x")
+        thread.join()
+        for fd in self.wake:
+            os.close(fd)
+
+    #runs on its own thread until stop() is called, reconnecting if the connection drops
+    def listen(self):
+        reconnecting = False
+        conn = None
+        while not self.stopping.is_set():
+            try:
+                #LISTEN needs a connection of its own for as long as the process runs, so it doesn't come out of the pool
+                conn = psycopg2.connect(dbname=db.database, **db.connect_params)
+                conn.autocommit = True
+                conn.cursor().execute("LISTEN {}; LISTEN {}".format(EVENT_CHANNEL, CACHE_CHANNEL))
+
+                #invalidations sent while the connection was down were missed, so anything cached could be stale
+                if reconnecting:
+                    for invalidate in CACHES.values():
+                        invalidate(None)
+
+                while True:
+                    ready, _, _ = select.select([conn, self.wake[0]], [], [], 30)
+                    if self.stopping.is_set():
+                        break
+                    if len(ready) == 0:
+                        #nothing happened, make sure the connection is still alive
+                        conn.cursor().execute("SELECT 1")
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        message = json.loads(notify.payload)
+                        if notify.channel == CACHE_CHANNEL:
+                            CACHES[message["cache"]](message["key"])
+                        else:
+                            self.add(message)
+            except Exception as e:
+                print("Event listener lost its connection: {}".format(e))
+                reconnecting = True
+                self.stopping.wait(5)
+
+        if conn is not None:
+            conn.close()
+
+    def add(self, event):
+        with self.condition:
+            self.seq += 1
+            self.events.append((self.seq, event))
+            self.condition.notify_all()
+
+    def cursor(self):
+        return "{}-{}".format(self.process, self.seq)
+
+    #the cursor for "everything after now"
+    def latest(self):
+        self.start()
+        with self.condition:
+            return self.cursor()
+
+    #waits up to timeout seconds for events after the cursor, returns (events, new cursor)
+    #each event is returned with its cursor as "id", so a client can pick up from any event
+    def wait(self, cursor, timeout):
+        self.start()
+        process, _, seq = cursor.partition("-")
+
+        with self.condition:
+            if process != self.process or not seq.isdigit() or int(seq) > self.seq:
+                return [{"id": self.cursor(), "type": "reset"}], self.cursor()
+
+            seq = int(seq)
+            oldest = self.events[0][0] if len(self.events) > 0 else self.seq + 1
+            if seq < oldest - 1:
+                return [{"id": self.cursor(), "type": "reset"}], self.cursor()
+
+            self.condition.wait_for(lambda: self.seq > seq, timeout)
+            events = [dict(event, id="{}-{}".format(self.process, s)) for s, event in self.events if s > seq]
+            return events, self.cursor()
+
+event_hub = EventHub(
+    backlog=int(getenv('EVENT_BACKLOG') or 1000),
+    max_listeners=int(getenv('EVENT_MAX_LISTENERS') or 8)
+)
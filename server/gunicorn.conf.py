@@ -0,0 +1,41 @@
+from os import getenv
+import multiprocessing
+import subprocess
+import sys
+
+#Runs the server as several worker processes with gunicorn, so it can use more than one CPU core. Linux only.
+#
+#   gunicorn -c gunicorn.conf.py
+#
+#Every worker keeps its own caches, database pool, image processing pool and scheduler. Changes that other workers
+#need to know about (i.e. a revoked API key) are broadcast through Postgres (see invalidate_everywhere in events.py).
+#
+#To deploy new code without dropping requests, send the master process SIGHUP (`kill -HUP <pid>`). It starts a fresh
+#set of workers on the new code and lets the old ones finish what they're doing before they exit
+
+bind = getenv('GUNICORN_BIND') or "0.0.0.0:80"
+workers = int(getenv('GUNICORN_WORKERS') or multiprocessing.cpu_count())
+#threads let a worker keep serving while some of its requests wait on Postgres or listen to /events
+worker_class = "gthread"
+threads = int(getenv('GUNICORN_THREADS') or 16)
+
+#the schema and the first API key are set up once by the master (see on_starting), not once per worker
+wsgi_app = "lmao_server:create_app(setup=False)"
+#the app is loaded separately in each worker, so a reload picks up new code
+preload_app = False
+
+#how long old workers get to finish their requests on a reload or shutdown. Clients on /events are cut off after this
+#and reconnect to a new worker on their own
+graceful_timeout = int(getenv('GUNICORN_GRACEFUL_TIMEOUT') or 30)
+
+#runs setup_database in a separate process so the master never imports the app itself. Workers are forked from the master,
+#so they would inherit whatever it had loaded and keep running the old code after a reload
+def setup_database():
+    subprocess.check_call([sys.executable, "-c", "from lmao_server import setup_database; setup_database()"])
+
+def on_starting(server):
+    setup_database()
+
+#a reload may be deploying code with new migrations, which have to run before the new workers start
+def on_reload(server):
+    setup_database()
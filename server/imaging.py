@@ -0,0 +1,58 @@
+import io
+from PIL import Image as PILImage, ImageOps
+
+#every image is kept at these sizes (in px, always square) along with the JPEG quality used to encode each one
+#small thumbnails can take a lower quality since there's less detail to lose
+SIZES = {
+    60: 75,
+    100: 80,
+    400: 85
+}
+
+#the size stored on the Image row itself, every other size is an ImageVariant
+FULL_SIZE = 400
+
+#scales an image to a size x size square, cropping whatever doesn't fit from the middle
+def make_square(img, size):
+    return ImageOps.fit(img, (size, size), PILImage.LANCZOS)
+
+#progressive JPEGs are slightly smaller and show something on screen before they finish downloading
+def encode_jpeg(img, size):
+    img_byte_arr = io.BytesIO()
+    img.save(img_byte_arr, format='JPEG', quality=SIZES[size], optimize=True, progressive=True)
+    return img_byte_arr.getvalue()
+
+#opens an upload without decoding more pixels than the largest size needs
+#JPEGs can be decoded straight at 1/2, 1/4 or 1/8 scale (draft mode), anything else is shrunk with reduce(),
+#which is much cheaper than a full resample. Both stop at 2x the target so the final resize still has detail to work with
+def open_reduced(data, size):
+    img = PILImage.open(io.BytesIO(data))
+    img.draft('RGB', (size * 2, size * 2))
+
+    factor = min(img.width, img.height) // (size * 2)
+    if factor > 1:
+        img = img.reduce(factor)
+
+    #phone photos are often stored sideways with a tag saying which way is up
+    img = ImageOps.exif_transpose(img)
+    #PNGs with transparency (and other odd modes) can't be saved as JPEG
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    return img
+
+#turns the bytes of an uploaded file into a JPEG at every size in SIZES, returns {size: bytes}
+#this runs in a separate process (see pipeline.py), so it can't touch the database
+def process_upload(data):
+    img = open_reduced(data, max(SIZES))
+
+    #sizes are made largest first, each from the one before it, so the full upload is only resized once
+    encoded = {}
+    for size in sorted(SIZES, reverse=True):
+        img = make_square(img, size)
+        encoded[size] = encode_jpeg(img, size)
+    return encoded
+
+#makes a single size from an already stored full size JPEG, used for images uploaded before sizes existed
+def make_variant(data, size):
+    img = PILImage.open(io.BytesIO(data)).convert('RGB')
+    return encode_jpeg(make_square(img, size), size)
@@ -1,24 +1,82 @@
 from os import getenv
+from threading import Thread
 from flask import Flask
 from werkzeug.wrappers import Request, Response
+from models import db, prune_tombstones, TOMBSTONE_PRUNE_INTERVAL
+from middleware import metrics_middleware, metrics_after_request
+from migrate import create_schema, SETUP_LOCK
 from routes.item import item_route
 from routes.user import user_route
 from routes.admin import admin
 from routes.checkout import checkout_route
 from routes.image import image_route
+from routes.sync import sync_route
+from routes.events import events_route
+from routes.report import report_route
+from routes.metrics import metrics_route
 from key_routine import key_routine
+from cache import warm_image_cache
+from reports import refresh_item_usage, scan_due, REPORT_REFRESH_INTERVAL, DUE_SCAN_INTERVAL
+from scheduler import scheduler
+from events import event_hub
 
-def create_app():
+#checks a connection out of the pool for the length of each request
+def open_db_connection():
+    db.connect(reuse_if_open=True)
+
+#and hands it back once the request is done, even if the request failed
+def close_db_connection(exc):
+    if not db.is_closed():
+        db.close()
+
+#creates the schema and the first API key. Safe to run from several processes at once, only one of them will make the key
+def setup_database():
+    create_schema()
+
+    with db.connection_context():
+        with db.atomic():
+            db.execute_sql("SELECT pg_advisory_xact_lock(%s)", (SETUP_LOCK,))
+            key_routine()
+
+#setup=False skips setup_database, for when it has already been run once for every process (see gunicorn.conf.py)
+def create_app(setup=True):
     app = Flask(__name__)
     app.config['SECRET_KEY'] = "a_ACZr49{m4YL@=Y"
 
+    #goes first so the time spent waiting for a database connection is counted too
+    app.before_request(metrics_middleware)
+    app.after_request(metrics_after_request)
+    app.before_request(open_db_connection)
+    app.teardown_request(close_db_connection)
+
     app.register_blueprint(item_route)
     app.register_blueprint(user_route)
     app.register_blueprint(checkout_route)
     app.register_blueprint(image_route)
+    app.register_blueprint(sync_route)
+    app.register_blueprint(events_route)
+    app.register_blueprint(report_route)
+    app.register_blueprint(metrics_route)
 
     admin.init_app(app)
 
-    key_routine()
+    if setup:
+        setup_database()
+
+    #listens for changes other server processes make to shared data, i.e. revoked API keys (see events.py)
+    event_hub.start()
+
+    #fills the image cache in the background so startup isn't held up by it
+    if getenv('IMAGE_CACHE_WARM', '1') != '0':
+        Thread(target=warm_image_cache, daemon=True).start()
+
+    #keeps the report summaries and the lists on the admin home page up to date, see reports.py
+    if REPORT_REFRESH_INTERVAL > 0:
+        scheduler.every(REPORT_REFRESH_INTERVAL, refresh_item_usage)
+    if DUE_SCAN_INTERVAL > 0:
+        scheduler.every(DUE_SCAN_INTERVAL, scan_due)
+    if TOMBSTONE_PRUNE_INTERVAL > 0:
+        scheduler.every(TOMBSTONE_PRUNE_INTERVAL, prune_tombstones)
+    scheduler.start()
 
-    return app
\ No newline at end of file
+    return app
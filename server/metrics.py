@@ -0,0 +1,151 @@
+from os import getenv
+from threading import Lock, local
+from contextlib import contextmanager
+import json
+import time
+
+#Counts and times every request and the database queries and other work done for it, so a slow request can be pinned
+#on auth, the database or image work. Everything is kept in memory per process and served in the Prometheus text
+#format at /metrics (see routes/metrics.py). The request hooks live in middleware.py and the query hook in models.py
+
+#requests that take longer than this many seconds get a log line with their breakdown
+SLOW_REQUEST_SECONDS = float(getenv('SLOW_REQUEST_SECONDS') or 1)
+#upper bounds of the request latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+#route label used for queries made outside of a request, i.e. by the scheduler or the image pipeline
+BACKGROUND = "background"
+
+#the request the current thread is working on, if any
+current = local()
+
+class RequestStats():
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_seconds = 0.0
+        #seconds spent in each phase (see timed), i.e. "auth" or "image"
+        self.phases = {}
+
+class Metrics():
+    def __init__(self):
+        self.lock = Lock()
+        #(method, route, status) -> count
+        self.requests = {}
+        #(method, route) -> [count in each bucket, count, total seconds]
+        self.latency = {}
+        #(method, route) -> [query count, query seconds]
+        self.db = {}
+        #(method, route, phase) -> seconds
+        self.phases = {}
+
+    def record_request(self, method, route, status, seconds, stats):
+        with self.lock:
+            key = (method, route, str(status))
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+            histogram = self.latency.setdefault((method, route), [[0] * len(LATENCY_BUCKETS), 0, 0.0])
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += 1
+            histogram[2] += seconds
+
+            self.add_queries((method, route), stats.queries, stats.db_seconds)
+            for phase, phase_seconds in stats.phases.items():
+                key = (method, route, phase)
+                self.phases[key] = self.phases.get(key, 0.0) + phase_seconds
+
+    #needs self.lock
+    def add_queries(self, key, count, seconds):
+        totals = self.db.setdefault(key, [0, 0.0])
+        totals[0] += count
+        totals[1] += seconds
+
+    def record_background_query(self, seconds):
+        with self.lock:
+            self.add_queries(("", BACKGROUND), 1, seconds)
+
+    #the metrics in the Prometheus text exposition format
+    def render(self):
+        lines = []
+        with self.lock:
+            lines.append("# HELP lmao_requests_total Requests handled, by route and response status")
+            lines.append("# TYPE lmao_requests_total counter")
+            for (method, route, status), count in sorted(self.requests.items()):
+                lines.append('lmao_requests_total{{method="{}",route="{}",status="{}"}} {}'.format(method, route, status, count))
+
+            lines.append("# HELP lmao_request_duration_seconds Time taken to handle a request, including writing out streamed responses")
+            lines.append("# TYPE lmao_request_duration_seconds histogram")
+            for (method, route), (buckets, count, total) in sorted(self.latency.items()):
+                labels = 'method="{}",route="{}"'.format(method, route)
+                for bound, bucket_count in zip(LATENCY_BUCKETS, buckets):
+                    lines.append('lmao_request_duration_seconds_bucket{{{},le="{}"}} {}'.format(labels, bound, bucket_count))
+                lines.append('lmao_request_duration_seconds_bucket{{{},le="+Inf"}} {}'.format(labels, count))
+                lines.append('lmao_request_duration_seconds_sum{{{}}} {}'.format(labels, total))
+                lines.append('lmao_request_duration_seconds_count{{{}}} {}'.format(labels, count))
+
+            lines.append("# HELP lmao_db_queries_total Database queries run, by the route that ran them")
+            lines.append("# TYPE lmao_db_queries_total counter")
+            for (method, route), (count, _) in sorted(self.db.items()):
+                lines.append('lmao_db_queries_total{{method="{}",route="{}"}} {}'.format(method, route, count))
+
+            lines.append("# HELP lmao_db_seconds_total Time spent waiting on database queries, by the route that ran them")
+            lines.append("# TYPE lmao_db_seconds_total counter")
+            for (method, route), (_, seconds) in sorted(self.db.items()):
+                lines.append('lmao_db_seconds_total{{method="{}",route="{}"}} {}'.format(method, route, seconds))
+
+            lines.append("# HELP lmao_request_phase_seconds_total Time spent in each phase of a request, i.e. auth or image work")
+            lines.append("# TYPE lmao_request_phase_seconds_total counter")
+            for (method, route, phase), seconds in sorted(self.phases.items()):
+                lines.append('lmao_request_phase_seconds_total{{method="{}",route="{}",phase="{}"}} {}'.format(method, route, phase, seconds))
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+def start_request():
+    current.stats = RequestStats()
+
+#records the request the current thread was working on, and logs it if it was slow or failed
+def finish_request(method, route, status, error=None, log=True):
+    stats = getattr(current, 'stats', None)
+    if stats is None:
+        return
+    current.stats = None
+
+    seconds = time.perf_counter() - stats.started
+    metrics.record_request(method, route, status, seconds, stats)
+
+    if log and (seconds >= SLOW_REQUEST_SECONDS or status >= 500):
+        line = {
+            "event": "slow_request" if status < 500 else "failed_request",
+            "method": method,
+            "route": route,
+            "status": status,
+            "seconds": round(seconds, 4),
+            "db_queries": stats.queries,
+            "db_seconds": round(stats.db_seconds, 4),
+            "phases": {phase: round(s, 4) for phase, s in stats.phases.items()}
+        }
+        if error is not None:
+            line["error"] = error
+        print(json.dumps(line), flush=True)
+
+#called by the database for every query (see models.py)
+def record_query(seconds):
+    stats = getattr(current, 'stats', None)
+    if stats is None:
+        metrics.record_background_query(seconds)
+    else:
+        stats.queries += 1
+        stats.db_seconds += seconds
+
+#times a block of work as one phase of the current request, does nothing outside of a request
+@contextmanager
+def timed(phase):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats = getattr(current, 'stats', None)
+        if stats is not None:
+            stats.phases[phase] = stats.phases.get(phase, 0.0) + time.perf_counter() - started
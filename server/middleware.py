@@ -1,11 +1,33 @@
 from flask import request, jsonify
-from peewee import DoesNotExist
-from models import ApiKey
+from cache import key_cache
+from metrics import start_request, finish_request, timed
 
 def auth_middleware():
-    auth_header = request.headers.get('Authorization', "").replace("Bearer ", "")
+    with timed("auth"):
+        auth_header = request.headers.get('Authorization', "").replace("Bearer ", "")
 
-    try:
-        ApiKey.select().where(ApiKey.code == auth_header).dicts().get()
-    except DoesNotExist:
-        return jsonify({"error": "Client is unauthorized"}), 401
\ No newline at end of file
+        if not key_cache.is_valid(auth_header):
+            return jsonify({"error": "Client is unauthorized"}), 401
+
+#starts timing a request, registered before everything else in create_app so the whole request is counted
+def metrics_middleware():
+    start_request()
+
+#the request is recorded once the response has been written out, so streamed responses count their full length
+def metrics_after_request(response):
+    #requests are grouped by route pattern (i.e. /image/<id>) so every ID doesn't get its own label
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    method = request.method
+    status = response.status_code
+
+    #the routes catch their own errors and answer with {"error": ...}, which is the only record of what went wrong
+    error = None
+    if status >= 500 and response.is_json:
+        body = response.get_json(silent=True)
+        error = body.get("error") if isinstance(body, dict) else None
+
+    #event streams stay open for as long as the client is listening, so they'd always look slow
+    log = response.mimetype != 'text/event-stream'
+
+    response.call_on_close(lambda: finish_request(method, route, status, error, log))
+    return response
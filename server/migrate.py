@@ -0,0 +1,104 @@
+import sys
+from datetime import datetime
+from peewee import DateTimeField
+from playhouse.migrate import PostgresqlMigrator, migrate
+from models import db, MODELS, Image, ImageVariant, Item, User, Checkout
+from storage import file_store
+
+#adds a column to an existing table if it isn't there yet
+def add_missing_column(migrator, table, name, field):
+    if name not in [c.name for c in db.get_columns(table)]:
+        migrate(migrator.add_column(table, name, field))
+
+#images can be stored on disk instead of in the database, so the blob became optional and the file hash was added
+def image_storage(migrator):
+    if not db.table_exists('images'):
+        return
+    add_missing_column(migrator, 'images', 'digest', Image.digest)
+    migrate(migrator.drop_not_null('images', 'image'))
+
+#uploads are processed in the background now, every image that already exists is ready to serve
+def image_status(migrator):
+    if not db.table_exists('images'):
+        return
+    add_missing_column(migrator, 'images', 'status', Image.status)
+
+#an item can only have one open checkout now (see the checkouts_open_item_id index), but older databases could
+#end up with more than one if two terminals raced. Keeps the newest of each and marks the rest as returned
+#once the index exists it keeps duplicates from happening, so this only has to run until then
+def close_duplicate_checkouts(migrator):
+    if not db.table_exists('checkouts'):
+        return
+    if "checkouts_open_item_id" in [i.name for i in db.get_indexes('checkouts')]:
+        return
+    newest = (Checkout
+              .select(Checkout.id)
+              .where(Checkout.return_date.is_null())
+              .order_by(Checkout.item_id, Checkout.start_date.desc())
+              .distinct([Checkout.item_id]))
+    closed = (Checkout
+              .update(return_date=datetime.now(), updated_at=datetime.now())
+              .where(Checkout.return_date.is_null() & Checkout.id.not_in(newest))
+              .execute())
+    if closed > 0:
+        print("Closed {} duplicate open checkouts".format(closed))
+
+#clients can pull just the rows that changed since they last asked (see routes/sync.py)
+#and reports only add up the checkouts that changed since they were last refreshed (see reports.py)
+#the column is added without an index since create_tables builds the model's own one. Older versions of this step
+#also had the migrator build one under a different name, which is dropped
+def change_tracking(migrator):
+    for model in [Image, Item, User, Checkout]:
+        table = model._meta.table_name
+        if db.table_exists(table):
+            add_missing_column(migrator, table, 'updated_at', DateTimeField(default=datetime.now))
+            db.execute_sql('DROP INDEX IF EXISTS "{}_updated_at"'.format(table))
+
+#brings databases created by older versions up to date with the models
+#every step has to be safe to run more than once (and on an empty database), since these run every time the server starts
+#steps run in order, so a step that writes to a column has to come after the step that adds it
+MIGRATIONS = [image_storage, image_status, change_tracking, close_duplicate_checkouts]
+
+#held while the schema is set up, so several server processes starting at once (see gunicorn.conf.py) take turns
+#any number will do, it just has to be the same in every server process
+SETUP_LOCK = 0x4c4d4153
+
+#sets up the database schema. This runs once when the server starts (see create_app)
+#but can also be run by hand with `python migrate.py` to set up a new database before deploying
+def create_schema():
+    migrator = PostgresqlMigrator(db)
+    with db.connection_context():
+        with db.atomic():
+            db.execute_sql("SELECT pg_advisory_xact_lock(%s)", (SETUP_LOCK,))
+            #migrations go first so every column exists by the time the indexes below are built
+            for step in MIGRATIONS:
+                step(migrator)
+            #safe=True skips any table or index that already exists, so this is fine to run against a live database
+            #it also builds any index that was added to the models after the table was created
+            db.create_tables(MODELS, safe=True)
+
+#one-shot move of every image (and every smaller size of it) still stored in the database over to the file store
+#run with `python migrate.py images`. Safe to stop and start again, rows that were already moved are skipped
+def move_images_to_files(batch_size=50):
+    moved = 0
+    with db.connection_context():
+        for model in [Image, ImageVariant]:
+            while True:
+                #the query is run again each time since moved rows drop out of it
+                batch = list(model.select().where(model.digest.is_null() & model.image.is_null(False)).limit(batch_size))
+                if len(batch) == 0:
+                    break
+
+                for row in batch:
+                    file_store.write(row, bytes(row.image))
+                    row.save()
+                moved += len(batch)
+                print("Moved {} images".format(moved))
+
+    return moved
+
+if __name__ == "__main__":
+    create_schema()
+
+    if "images" in sys.argv[1:]:
+        move_images_to_files()
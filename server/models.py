@@ -1,43 +1,168 @@
 from os import getenv
-from datetime import datetime
+from datetime import datetime, timedelta
 import uuid
-from peewee import PostgresqlDatabase, Model, TextField, ForeignKeyField, DateTimeField, IntegerField, BlobField
+import time
+import weakref
+from peewee import Model, TextField, ForeignKeyField, DateTimeField, IntegerField, FloatField, BlobField, DatabaseError, OperationalError, InterfaceError
+from psycopg2.errors import InvalidSqlStatementName
+from playhouse.pool import PooledPostgresqlExtDatabase
+from playhouse.shortcuts import ReconnectMixin
+from metrics import record_query
 
 def gen_uuid():
     return str(uuid.uuid4())
 
-db = PostgresqlDatabase(
-    'inventory', 
+#retries a query once on a fresh connection if the one it got was killed (i.e. Postgres restarted)
+#the Ext flavour is needed for server-side cursors (see playhouse.postgres_ext.ServerSide)
+#every query goes through execute_sql, so it's also where queries are counted and timed for /metrics (see metrics.py)
+class ReconnectingPooledDatabase(ReconnectMixin, PooledPostgresqlExtDatabase):
+    #ReconnectMixin only knows MySQL's errors, these are what psycopg2 raises for a dropped connection
+    reconnect_errors = ReconnectMixin.reconnect_errors + (
+        (OperationalError, 'server closed the connection'),
+        (OperationalError, 'terminating connection'),
+        (InterfaceError, 'connection already closed'),
+    )
+
+    def execute_sql(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            #the rest of a transaction can't carry on on a new connection, so queries inside one aren't retried
+            if self.in_transaction():
+                return super(ReconnectMixin, self).execute_sql(*args, **kwargs)
+            return super().execute_sql(*args, **kwargs)
+        finally:
+            record_query(time.perf_counter() - started)
+
+#connections are not opened here. Each request checks one out of the pool and returns it when it ends
+#(see create_app), anything running outside of a request should use db.connection_context()
+db = ReconnectingPooledDatabase(
+    getenv('POSTGRES_DB') or 'inventory',
     user=getenv('POSTGRES_USER'), 
     password=getenv('POSTGRES_PASSWORD'), 
     host=getenv('POSTGRES_HOST'),
-    port=getenv('POSTGRES_PORT') or 5432
+    port=getenv('POSTGRES_PORT') or 5432,
+    #run.bat gives waitress 16 threads, but clients waiting on /events give their connection back (see routes/events.py)
+    #so this only has to cover the requests actually running queries, plus some room for background work
+    max_connections=int(getenv('POSTGRES_MAX_CONNECTIONS') or 8),
+    #connections idle for longer than this are thrown away instead of being handed out again
+    stale_timeout=int(getenv('POSTGRES_STALE_TIMEOUT') or 300)
 )
 
-db.connect()
+#a query Postgres plans once per connection instead of on every run. It's prepared on each pooled connection
+#the first time it's used there, params are the Postgres types of its $1, $2... placeholders
+class PreparedStatement():
+    def __init__(self, name, params, sql):
+        self.name = name
+        self.prepare_sql = "PREPARE {} ({}) AS {}".format(name, ", ".join(params), sql)
+        self.execute_sql = "EXECUTE {} ({})".format(name, ", ".join(["%s"] * len(params)))
+        #connections that have it prepared already, which drop out once they're closed
+        self.prepared = weakref.WeakSet()
+
+    #runs on the current connection and returns the cursor
+    def execute(self, *args):
+        self.prepare()
+        try:
+            return db.execute_sql(self.execute_sql, args)
+        except DatabaseError as e:
+            #the connection was killed and ReconnectMixin retried on a fresh one, which hasn't had it prepared yet.
+            #Outside a transaction the failed EXECUTE can be rolled back and run again, inside one the transaction is lost anyway
+            if not isinstance(getattr(e, 'orig', None), InvalidSqlStatementName) or db.in_transaction():
+                raise
+            db.rollback()
+            self.prepare()
+            return db.execute_sql(self.execute_sql, args)
+
+    def prepare(self):
+        conn = db.connection()
+        if conn not in self.prepared:
+            db.execute_sql(self.prepare_sql)
+            self.prepared.add(conn)
+
+#records rows that were deleted from tracked tables, so /sync can tell clients to drop them
+#they're only kept for TOMBSTONE_RETENTION_DAYS (see prune_tombstones), clients that last synced before that start over
+class Tombstone(Model):
+    table = TextField()
+    row_id = TextField()
+    deleted_at = DateTimeField(default=datetime.now, index=True)
 
-class Image(Model):
+    class Meta:
+        database = db
+        table_name = "tombstones"
+
+TOMBSTONE_RETENTION = timedelta(days=int(getenv('TOMBSTONE_RETENTION_DAYS') or 30))
+#seconds between prunes (see scheduler.py), 0 turns pruning off
+TOMBSTONE_PRUNE_INTERVAL = int(getenv('TOMBSTONE_PRUNE_INTERVAL') or 3600)
+
+def prune_tombstones():
+    Tombstone.delete().where(Tombstone.deleted_at < datetime.now() - TOMBSTONE_RETENTION).execute()
+
+#base for the tables clients keep copies of (see routes/sync.py) or that reports are worked out from (see reports.py)
+#updated_at is bumped on every save and deletes leave a Tombstone behind
+#bulk queries (Model.update/delete) skip both, so they have to set updated_at or add a Tombstone themselves
+class TrackedModel(Model):
+    updated_at = DateTimeField(default=datetime.now, index=True)
+
+    def save(self, *args, **kwargs):
+        self.updated_at = datetime.now()
+        #saves limited to some fields still have to record that the row changed
+        if kwargs.get('only') is not None:
+            kwargs['only'] = list(kwargs['only']) + [type(self).updated_at]
+        return super().save(*args, **kwargs)
+
+    def delete_instance(self, *args, **kwargs):
+        with self._meta.database.atomic():
+            Tombstone.create(table=self._meta.table_name, row_id=self.get_id())
+            return super().delete_instance(*args, **kwargs)
+
+class Image(TrackedModel):
     id = TextField(primary_key=True, default=gen_uuid)
-    image = BlobField()
+    #only one of these is set, depending on where the image is stored (see storage.py)
+    image = BlobField(null=True)
+    digest = TextField(null=True)
+    #uploads are processed in the background, this is "processing" until they're ready to be served (see pipeline.py)
+    status = TextField(default="ready")
 
     class Meta:
         database = db
         table_name = "images"
 
-class Item(Model):
+    #deleting an image from the admin panel detaches it from its items, which counts as a change to those items
+    def delete_instance(self, *args, **kwargs):
+        with self._meta.database.atomic():
+            Item.update(image=None, updated_at=datetime.now()).where(Item.image == self.id).execute()
+            return super().delete_instance(*args, **kwargs)
+
+#smaller copies of an image, made when it is uploaded (see imaging.py)
+class ImageVariant(Model):
+    id = TextField(primary_key=True, default=gen_uuid)
+    image_id = ForeignKeyField(Image, backref='variants', on_delete='CASCADE')
+    size = IntegerField()
+    #only one of these is set, just like on Image
+    image = BlobField(null=True)
+    digest = TextField(null=True)
+
+    class Meta:
+        database = db
+        table_name = "image_variants"
+        indexes = (
+            (('image_id', 'size'), True),
+        )
+
+class Item(TrackedModel):
     id = TextField(primary_key=True, default=gen_uuid)
     barcode = TextField(unique=True)
     name = TextField()
     area = IntegerField(null=True)
     image = ForeignKeyField(Image, null=True)
     description = TextField(null=True)
-    last_calibration = DateTimeField(null=True)
+    #indexed for the calibration reports, which look for items calibrated before a date (see reports.py)
+    last_calibration = DateTimeField(null=True, index=True)
 
     class Meta:
         database = db
         table_name = "items"
 
-class User(Model):
+class User(TrackedModel):
     id = TextField(primary_key=True, default=gen_uuid)
     gtid = TextField(unique=True)
     name = TextField()
@@ -47,9 +172,10 @@ class User(Model):
         database = db
         table_name = "users"
 
-class Checkout(Model):
+class Checkout(TrackedModel):
     id = TextField(primary_key=True, default=gen_uuid)
-    start_date = DateTimeField(default=datetime.now())
+    #indexed for the admin panel, which sorts by this
+    start_date = DateTimeField(default=datetime.now, index=True)
     #Returned date being null indicates that the item has not been returned
     return_date = DateTimeField(null=True)
     item_id = ForeignKeyField(Item)
@@ -59,6 +185,34 @@ class Checkout(Model):
         database = db
         table_name = "checkouts"
 
+#almost every lookup is for checkouts that haven't been returned yet, which are a tiny slice of the table,
+#so these partial indexes only cover open checkouts
+#the unique one also makes sure an item can only be checked out once, even if two terminals try at the same time
+Checkout.add_index(Checkout.index(Checkout.item_id, unique=True, where=Checkout.return_date.is_null(), name="checkouts_open_item_id"))
+Checkout.add_index(Checkout.index(Checkout.user_id, where=Checkout.return_date.is_null(), name="checkouts_open_user_id"))
+
+#checkout totals for each item, added up in the background for the reports (see reports.py) instead of on every request
+class ItemUsage(Model):
+    item_id = ForeignKeyField(Item, primary_key=True, on_delete='CASCADE')
+    checkouts = IntegerField(default=0)
+    returns = IntegerField(default=0)
+    #total time out of every returned checkout
+    loan_seconds = FloatField(default=0)
+    last_checkout = DateTimeField(null=True)
+
+    class Meta:
+        database = db
+        table_name = "item_usage"
+
+#when each background summary (i.e. item_usage) was last brought up to date
+class ReportState(Model):
+    name = TextField(primary_key=True)
+    refreshed_at = DateTimeField()
+
+    class Meta:
+        database = db
+        table_name = "report_state"
+
 class ApiKey(Model):
     code = TextField(default=gen_uuid)
 
@@ -66,6 +220,5 @@ class ApiKey(Model):
         database = db
         table_name = "api_keys"
 
-
-
-db.create_tables([Item, User, Checkout, ApiKey, Image])
\ No newline at end of file
+#every table in the system, in the order they need to be created
+MODELS = [Tombstone, Image, ImageVariant, Item, User, Checkout, ItemUsage, ReportState, ApiKey]
@@ -0,0 +1,81 @@
+from os import getenv
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future
+from threading import BoundedSemaphore, Lock
+from models import db, Image, ImageVariant
+from storage import store
+from imaging import FULL_SIZE, process_upload
+
+#Decoding, resizing and encoding uploads is slow and holds the GIL, so it's done in a pool of worker processes
+#instead of on the waitress thread that received the upload. Only a fixed number of uploads can be waiting
+#or in progress at once, anything past that is turned away (see put_image) so uploads can't starve checkouts
+class ImagePipeline():
+    def __init__(self, workers, max_pending):
+        self.workers = workers
+        self.slots = BoundedSemaphore(max_pending)
+        self.executor = None
+        #finished uploads are written to the database and storage on these threads, not on the thread that
+        #collects results from the worker processes, so a slow write doesn't hold up every other upload
+        self.writer = None
+        self.lock = Lock()
+
+    #the pool is started on first use so importing this module (i.e. from migrate.py) doesn't spawn processes
+    def get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(max_workers=self.workers)
+                self.writer = ThreadPoolExecutor(max_workers=self.workers)
+            return self.executor
+
+    #claims a spot in the queue, returns False if the queue is full
+    def reserve(self):
+        return self.slots.acquire(blocking=False)
+
+    def release(self):
+        self.slots.release()
+
+    #processes the upload for an already saved Image row with a reserved spot in the queue
+    #returns a Future that finishes once every size has been stored and the image is ready to serve
+    def submit(self, image_id, data):
+        stored = Future()
+        job = self.get_executor().submit(process_upload, data)
+        job.add_done_callback(lambda job: self.writer.submit(self.finish, image_id, job, stored))
+        return stored
+
+    #runs on a writer thread once a worker is done with an upload
+    def finish(self, image_id, job, stored):
+        try:
+            encoded = job.result()
+            with db.connection_context():
+                with db.atomic():
+                    image = Image.get_by_id(image_id)
+                    store.write(image, encoded[FULL_SIZE])
+                    image.status = "ready"
+
+                    for size, data in encoded.items():
+                        if size == FULL_SIZE:
+                            continue
+                        variant = ImageVariant(image_id=image, size=size)
+                        store.write(variant, data)
+                        variant.save(force_insert=True)
+
+                    image.save()
+            stored.set_result(image_id)
+        except Exception as e:
+            #whether processing or saving failed, the image would otherwise be left "processing" forever
+            self.mark_failed(image_id)
+            stored.set_exception(e)
+        finally:
+            self.release()
+
+    def mark_failed(self, image_id):
+        try:
+            with db.connection_context():
+                Image.update(status="failed", updated_at=datetime.now()).where(Image.id == image_id).execute()
+        except Exception as e:
+            print("Couldn't mark image {} as failed: {}".format(image_id, e))
+
+image_pipeline = ImagePipeline(
+    workers=int(getenv('IMAGE_WORKERS') or 2),
+    max_pending=int(getenv('IMAGE_QUEUE_SIZE') or 8)
+)
@@ -0,0 +1,138 @@
+from os import getenv
+from datetime import datetime, timedelta
+from threading import Lock
+from peewee import fn
+from models import db, Checkout, Item, User, ItemUsage, ReportState, Tombstone, TOMBSTONE_RETENTION
+
+#items need calibrating again after this many days (also used for the warning on checkout receipts)
+CALIBRATION_DAYS = 330
+#items are listed as coming due for calibration this many days before they're overdue
+CALIBRATION_NOTICE_DAYS = int(getenv('CALIBRATION_NOTICE_DAYS') or 30)
+#checkouts open for longer than this many days are overdue
+LOAN_DAYS = int(getenv('LOAN_DAYS') or 14)
+
+#Adding up every checkout for the usage reports is a scan of the whole checkouts table, which slows down the terminals
+#if it's done on every request. Instead the totals for each item are kept in item_usage and brought up to date
+#in the background every REPORT_REFRESH_INTERVAL seconds. Each refresh only adds up the checkouts of items
+#that had a checkout change since the last one (using the updated_at index), so it stays cheap as the table grows
+
+#seconds between refreshes (see scheduler.py), 0 turns the background refresh off
+REPORT_REFRESH_INTERVAL = int(getenv('REPORT_REFRESH_INTERVAL') or 300)
+#same idea as SYNC_OVERLAP in routes/sync.py, checkouts that commit a moment late are still picked up
+REPORT_OVERLAP = timedelta(seconds=5)
+#any number will do, it just has to be the same in every server process
+REPORT_LOCK = 0x4c4d414f
+
+#brings item_usage up to date, needs a database connection. Returns False if another process was already doing it
+def refresh_item_usage():
+    with db.atomic():
+        #only one server process refreshes at a time, the rest skip their turn
+        if not db.execute_sql("SELECT pg_try_advisory_xact_lock(%s)", (REPORT_LOCK,)).fetchone()[0]:
+            return False
+
+        started = datetime.now()
+        state = ReportState.get_or_none(ReportState.name == ItemUsage._meta.table_name)
+        since = state.refreshed_at - REPORT_OVERLAP if state is not None else None
+        #deleted checkouts from before the oldest tombstone can't be seen anymore
+        if since is not None and since < started - TOMBSTONE_RETENTION:
+            since = None
+
+        totals = usage_totals()
+
+        #deleted checkouts can't be traced back to their item, so (like the first refresh) everything is added up again
+        deleted = since is not None and Tombstone.select().where(
+            (Tombstone.table == Checkout._meta.table_name) & (Tombstone.deleted_at > since)
+        ).exists()
+        if since is None or deleted:
+            ItemUsage.delete().execute()
+        else:
+            changed = Checkout.select(Checkout.item_id).where(Checkout.updated_at > since)
+            totals = totals.where(Checkout.item_id.in_(changed))
+
+        save_usage(totals)
+
+        ReportState.insert(name=ItemUsage._meta.table_name, refreshed_at=started).on_conflict(
+            conflict_target=[ReportState.name],
+            preserve=[ReportState.refreshed_at]
+        ).execute()
+    return True
+
+#adds up the checkouts of just these items straight away. The refresh only looks at items with a checkout that changed,
+#so this is for an item whose checkout was moved to another item in the admin panel (see CheckoutAdmin)
+def refresh_item_usage_for(item_ids):
+    with db.atomic():
+        #waits for a refresh that's running, so it can't write totals from before this change over these
+        db.execute_sql("SELECT pg_advisory_xact_lock(%s)", (REPORT_LOCK,))
+        #an item left without any checkouts doesn't come back from usage_totals, so its old totals are removed first
+        ItemUsage.delete().where(ItemUsage.item_id.in_(item_ids)).execute()
+        save_usage(usage_totals().where(Checkout.item_id.in_(item_ids)))
+
+#item_usage rows for every item with a checkout
+def usage_totals():
+    return Checkout.select(
+        Checkout.item_id,
+        fn.COUNT(Checkout.id),
+        fn.COUNT(Checkout.return_date),
+        fn.COALESCE(fn.SUM(fn.date_part('epoch', Checkout.return_date - Checkout.start_date)), 0),
+        fn.MAX(Checkout.start_date)
+    ).group_by(Checkout.item_id)
+
+def save_usage(totals):
+    fields = [ItemUsage.item_id, ItemUsage.checkouts, ItemUsage.returns, ItemUsage.loan_seconds, ItemUsage.last_checkout]
+    ItemUsage.insert_from(totals, fields).on_conflict(
+        conflict_target=[ItemUsage.item_id],
+        preserve=fields[1:]
+    ).execute()
+
+#when item_usage was last brought up to date, or None if it never has been
+def usage_refreshed_at():
+    state = ReportState.get_or_none(ReportState.name == ItemUsage._meta.table_name)
+    return state.refreshed_at if state is not None else None
+
+#open checkouts are a tiny slice of the table and have their own partial indexes, so this is cheap enough to run live
+def overdue_query():
+    return Checkout.select(
+        Checkout.id, Checkout.start_date, Item.barcode, Item.name.alias('item_name'), Item.area,
+        User.gtid, User.name.alias('user_name'), User.email
+    ).join(Item).switch(Checkout).join(User).where(
+        Checkout.return_date.is_null() & (Checkout.start_date < datetime.now() - timedelta(days=LOAN_DAYS))
+    ).order_by(Checkout.start_date)
+
+#items last calibrated more than this many days ago, oldest first. Uses the index on last_calibration
+def calibration_query(days):
+    return Item.select(Item.id, Item.barcode, Item.name, Item.area, Item.last_calibration).where(
+        Item.last_calibration < datetime.now() - timedelta(days=days)
+    ).order_by(Item.last_calibration)
+
+#the latest lists of everything that needs someone's attention, worked out every DUE_SCAN_INTERVAL seconds by scan_due
+#so the admin home page and /report/due never have to query for them
+class DueList():
+    def __init__(self):
+        self.lists = {"calibration_overdue": [], "calibration_due": [], "overdue_loans": []}
+        self.scanned_at = None
+        self.lock = Lock()
+
+    def update(self, lists):
+        with self.lock:
+            self.lists = lists
+            self.scanned_at = datetime.now()
+
+    def get(self):
+        with self.lock:
+            return dict(self.lists, scanned_at=self.scanned_at)
+
+due_list = DueList()
+
+#seconds between scans for overdue calibrations and loans, 0 turns the scan off
+DUE_SCAN_INTERVAL = int(getenv('DUE_SCAN_INTERVAL') or 300)
+
+def scan_due():
+    #one query covers both overdue and coming due, and they're split up here
+    overdue_before = datetime.now() - timedelta(days=CALIBRATION_DAYS)
+    calibration = list(calibration_query(CALIBRATION_DAYS - CALIBRATION_NOTICE_DAYS).dicts())
+
+    due_list.update({
+        "calibration_overdue": [i for i in calibration if i['last_calibration'] < overdue_before],
+        "calibration_due": [i for i in calibration if i['last_calibration'] >= overdue_before],
+        "overdue_loans": list(overdue_query().dicts())
+    })
@@ -7,14 +7,16 @@ from wtforms import StringField
 from flask_admin.contrib.peewee import ModelView
 from flask_admin.model.form import InlineFormAdmin
 from functools import partial
+from cache import key_cache
+from events import item_event, user_event, invalidate_everywhere
+from reports import due_list, refresh_item_usage_for, CALIBRATION_DAYS, LOAN_DAYS
 import base64
 
 class AuthController():
     def is_accessible(self):
         try:
             api_key = request.cookies.get('api_key')
-            ApiKey.select().where(ApiKey.code == api_key).dicts().get()
-            return True
+            return key_cache.is_valid(api_key)
         except Exception as e:
             print(e)
             return False
@@ -26,7 +28,8 @@ class AuthController():
 class HomeView(AuthController, AdminIndexView):
     @expose('/')
     def index(self):
-        return self.render('home.html')
+        #comes from memory, see scan_due in reports.py
+        return self.render('home.html', due=due_list.get(), calibration_days=CALIBRATION_DAYS, loan_days=LOAN_DAYS)
 
 class LoginView(AuthController, BaseView):
     @expose('/')
@@ -43,8 +46,9 @@ class ItemAdmin(AuthController, ModelView):
 
     column_searchable_list = (Item.name, Item.description, Item.barcode)
 
+    #uses the raw image ID so rendering the list doesn't load every image row (and its blob) one at a time
     column_formatters = {
-        'image': lambda v, c, m, p: Markup('<img src="{}" style="width:100px;height:100px">'.format("/image/{}".format(m.image))) if m.image else "None Attached"
+        'image': lambda v, c, m, p: Markup('<img src="{}" style="width:100px;height:100px">'.format("/image/{}?size=100".format(m.image_id))) if m.image_id else "None Attached"
     }
 
     form_overrides = {
@@ -62,6 +66,13 @@ class ItemAdmin(AuthController, ModelView):
          self._template_args['api_key'] = request.cookies.get('api_key')
          return super(ItemAdmin, self).create_view()
 
+    #lets live dashboards know about edits made here too (see events.py)
+    def after_model_change(self, form, model, is_created):
+        item_event(model)
+
+    def after_model_delete(self, model):
+        item_event(model, deleted=True)
+
 class CheckoutAdmin(AuthController, ModelView):
     form_ajax_refs = {
         'user_id': {
@@ -77,9 +88,22 @@ class CheckoutAdmin(AuthController, ModelView):
     def get_column_names(self, only_columns, excluded_columns):
         return [('start_date', 'Start Date'), ('return_date', 'Return Date'), ('item_id.name', 'Item Name'), ('item_id.barcode', 'Item Barcode'), ('user_id.name', 'User Name'), ('user_id.gtid', 'User GTID')]
 
+    #the list shows item and user columns, so both are joined in here instead of being loaded one row at a time
     def get_query(self):
-        return self.model.select().join(Item)
+        return self.model.select(Checkout, Item, User).join(Item).switch(Checkout).join(User)
+
+    #a checkout moved to another item still counts towards the old one in the usage report until that's added up again
+    #the form has already been copied onto the model here, so the old item comes from the database
+    def on_model_change(self, form, model, is_created):
+        model.moved_from = None
+        if not is_created:
+            previous = Checkout.select(Checkout.item_id).where(Checkout.id == model.id).scalar()
+            if previous != model.item_id_id:
+                model.moved_from = previous
 
+    def after_model_change(self, form, model, is_created):
+        if model.moved_from is not None:
+            refresh_item_usage_for([model.moved_from])
 
     can_view_details=True
     can_create=False
@@ -87,19 +111,44 @@ class CheckoutAdmin(AuthController, ModelView):
 class UserAdmin(AuthController, ModelView):
     column_searchable_list = (User.name, User.gtid, User.email)
 
+    def after_model_change(self, form, model, is_created):
+        user_event(model)
+
+    def after_model_delete(self, model):
+        user_event(model, deleted=True)
+
 class ApiAdmin(AuthController, ModelView):
-    pass
+    #keys are cached by the auth middleware, so any change here has to be pushed out of the cache right away,
+    #in every server process (see invalidate_everywhere)
+    #edits can change the code itself, so the old code isn't known anymore and the whole cache is dropped
+    def after_model_change(self, form, model, is_created):
+        invalidate_everywhere("keys")
+
+    #the bulk delete action only calls on_model_delete, so invalidate both before and after the row goes away
+    def on_model_delete(self, model):
+        invalidate_everywhere("keys", model.code)
+
+    def after_model_delete(self, model):
+        invalidate_everywhere("keys", model.code)
 
 class ImageAdmin(AuthController, ModelView):
 
     column_formatters = {
-        'image': lambda v, c, m, p: Markup('<img src="{}" style="width:100px;height:100px">'.format("/image/{}".format(m.id))) if m.image else "None Attached"
+        'image': lambda v, c, m, p: Markup('<img src="{}" style="width:100px;height:100px">'.format("/image/{}?size=100".format(m.id)))
     }
 
+    #the list only needs the ID to render thumbnails, so don't drag every blob out of the database with it
+    def get_query(self):
+        return self.model.select(Image.id, Image.digest)
+
     can_edit = False
     can_view_details = True
     create_template = "image_create.html"
 
+    #every server process may have this image cached
+    def after_model_delete(self, model):
+        invalidate_everywhere("images", model.id)
+
     @expose('/new/', methods=('GET', 'POST'))
     def create_view(self):
          self._template_args['api_key'] = request.cookies.get('api_key')
@@ -1,12 +1,23 @@
 from flask import Blueprint, request, jsonify
-from models import Checkout, User, Item
-from datetime import datetime, date
+from models import db, Checkout, User, Item
+from datetime import datetime
 from peewee import IntegrityError, DoesNotExist
 from middleware import auth_middleware
+from events import checkout_event, checkout_payload, publish_all
+from reports import CALIBRATION_DAYS
 
 checkout_route = Blueprint("checkout-route", __name__)
 checkout_route.before_request(auth_middleware)
 
+#builds the calibration warning shown on the receipt, or None if the item is still in calibration
+def calibration_message(last_calibration):
+    #last_calibration is a datetime, so compare against now() instead of today()
+    time_since_cal = (datetime.now() - last_calibration).days if last_calibration is not None else 0
+
+    if time_since_cal > CALIBRATION_DAYS:
+        return "⚠ Not calibrated in {} days!".format(time_since_cal)
+    return None
+
 @checkout_route.post('/checkout')
 def create_checkout():
     try:
@@ -15,20 +26,24 @@ def create_checkout():
         item = Item.get(Item.barcode == body['barcode'])
         
         try:
-            past_checkout = Checkout.get(
+            #the owner's name comes along with the open checkout so the error doesn't need another query
+            owner = Checkout.select(User.name).join(User).where(
                 (Checkout.item_id == item) & (Checkout.return_date.is_null())
-            )
-            if past_checkout is not None:
-                owning_user = User.get_by_id(past_checkout.user_id)
-                return {"error": "This item is already checked out by {}".format(owning_user.name)}, 403
+            ).dicts().get()
+            return {"error": "This item is already checked out by {}".format(owner['name'])}, 403
         except DoesNotExist:
             new_checkout = Checkout(item_id=item, user_id=user)
-            new_checkout.save(force_insert=True)
+            try:
+                with db.atomic():
+                    new_checkout.save(force_insert=True)
+                    checkout_event("checkout", new_checkout, item, user)
+            except IntegrityError:
+                #another terminal checked it out between the lookup above and now (see checkouts_open_item_id)
+                return {"error": "This item was just checked out at another terminal"}, 403
 
-            time_since_cal = (date.today() - item.last_calibration).days if item.last_calibration is not None else 0
-            
-            if time_since_cal > 330:
-                return {"id": new_checkout.id, "message": "⚠ Not calibrated in {} days!".format(time_since_cal)}
+            message = calibration_message(item.last_calibration)
+            if message is not None:
+                return {"id": new_checkout.id, "message": message}
             else:
                 return {"id": new_checkout.id}
     except KeyError:
@@ -40,10 +55,15 @@ def create_checkout():
 def delete_checkout():
     try:
         body = request.get_json()
-        item = Item.get(Item.barcode == body['barcode'])
-        ended_checkout = Checkout.get((Checkout.item_id == item) & (Checkout.return_date.is_null()))
+        #finds the open checkout by barcode with its item and user in one query
+        ended_checkout = Checkout.select(Checkout, Item, User).join(Item).switch(Checkout).join(User).where(
+            (Item.barcode == body['barcode']) & (Checkout.return_date.is_null())
+        ).get()
+        item = ended_checkout.item_id
         ended_checkout.return_date = datetime.now()
-        ended_checkout.save()
+        with db.atomic():
+            ended_checkout.save(only=[Checkout.return_date])
+            checkout_event("return", ended_checkout, item, ended_checkout.user_id)
 
         if not ended_checkout.user_id.gtid == str(body['gtid']):
             return {"id": ended_checkout.id, "message": "This item is returned for {}".format(ended_checkout.user_id.name)}
@@ -56,3 +76,111 @@ def delete_checkout():
     except Exception as e:
         return {"error": str(e), "type": type(e).__name__}, 500
 
+#bulk requests can say when they happened with an ISO 8601 "at" field, which terminals use for carts
+#they saved while they couldn't reach the server. Defaults to now
+def request_time(body):
+    return datetime.fromisoformat(body['at']) if body.get('at') else datetime.now()
+
+#checks out a whole cart at once. Takes {"gtid": ..., "barcodes": [...]} and returns a list with one result per barcode,
+#in the same order, each looking like the response from POST /checkout plus the barcode it belongs to
+@checkout_route.post('/checkout/bulk')
+def create_bulk_checkout():
+    try:
+        body = request.get_json()
+        barcodes = [str(b) for b in body['barcodes']]
+
+        with db.atomic():
+            user = User.get(User.gtid == body['gtid'])
+            #resolve every barcode and every existing open checkout in one query each, instead of a few per item
+            items = {i.barcode: i for i in Item.select().where(Item.barcode.in_(barcodes))}
+            owners = {
+                c['item_id']: c['name'] for c in Checkout.select(Checkout.item_id, User.name).join(User).where(
+                    (Checkout.item_id.in_([i.id for i in items.values()])) & (Checkout.return_date.is_null())
+                ).dicts()
+            }
+
+            results = []
+            new_checkouts = []
+            now = request_time(body)
+            for barcode in barcodes:
+                item = items.get(barcode)
+                if item is None:
+                    results.append({"barcode": barcode, "error": "This item does not exist"})
+                elif item.id in owners:
+                    results.append({"barcode": barcode, "error": "This item is already checked out by {}".format(owners[item.id])})
+                else:
+                    new_checkout = Checkout(item_id=item, user_id=user, start_date=now)
+                    new_checkouts.append(new_checkout)
+                    #stops the same barcode from being checked out twice if it shows up more than once in the cart
+                    owners[item.id] = user.name
+
+                    result = {"barcode": barcode, "id": new_checkout.id}
+                    message = calibration_message(item.last_calibration)
+                    if message is not None:
+                        result["message"] = message
+                    results.append(result)
+
+            if len(new_checkouts) > 0:
+                Checkout.bulk_create(new_checkouts)
+                publish_all([checkout_payload("checkout", c, c.item_id, user) for c in new_checkouts])
+
+        return jsonify(results)
+    except ValueError:
+        return {"error": "at must be an ISO 8601 date and time"}, 400
+    except KeyError:
+        return {"error": "Missing required information to check out these items"}, 400
+    except User.DoesNotExist:
+        return {"error": "User does not exist"}, 404
+    except IntegrityError:
+        #one of the items was checked out at another terminal while this cart was being processed, nothing was saved
+        return {"error": "Some of these items were just checked out at another terminal, please try again"}, 409
+    except Exception as e:
+        return {"error": str(e), "type": type(e).__name__}, 500
+
+#returns a whole cart at once, takes the same body as POST /checkout/bulk and responds in the same format
+@checkout_route.delete('/checkout/bulk')
+def delete_bulk_checkout():
+    try:
+        body = request.get_json()
+        barcodes = [str(b) for b in body['barcodes']]
+        gtid = str(body['gtid'])
+
+        with db.atomic():
+            items = {i.barcode: i for i in Item.select().where(Item.barcode.in_(barcodes))}
+            #pulls the owning user in with each checkout so the "returned for" message doesn't need another query
+            open_checkouts = {
+                c.item_id_id: c for c in Checkout.select(Checkout, User).join(User).where(
+                    (Checkout.item_id.in_([i.id for i in items.values()])) & (Checkout.return_date.is_null())
+                )
+            }
+
+            results = []
+            ended = []
+            for barcode in barcodes:
+                item = items.get(barcode)
+                #popped so a barcode scanned twice is only returned once
+                ended_checkout = open_checkouts.pop(item.id, None) if item is not None else None
+                if item is None:
+                    results.append({"barcode": barcode, "error": "This item does not exist"})
+                elif ended_checkout is None:
+                    results.append({"barcode": barcode, "error": "This item is already checked back in"})
+                else:
+                    ended.append((ended_checkout, item))
+                    result = {"barcode": barcode, "id": ended_checkout.id}
+                    if not ended_checkout.user_id.gtid == gtid:
+                        result["message"] = "This item is returned for {}".format(ended_checkout.user_id.name)
+                    results.append(result)
+
+            if len(ended) > 0:
+                Checkout.update(return_date=request_time(body), updated_at=datetime.now()).where(
+                    (Checkout.id.in_([c.id for c, _ in ended])) & (Checkout.return_date.is_null())
+                ).execute()
+                publish_all([checkout_payload("return", c, item, c.user_id) for c, item in ended])
+
+        return jsonify(results)
+    except ValueError:
+        return {"error": "at must be an ISO 8601 date and time"}, 400
+    except KeyError:
+        return {"error": "Missing required information to check in these items"}, 400
+    except Exception as e:
+        return {"error": str(e), "type": type(e).__name__}, 500
@@ -0,0 +1,76 @@
+from flask import Blueprint, request, json, jsonify, Response
+from models import db
+from cache import key_cache
+from events import event_hub
+from metrics import timed
+
+events_route = Blueprint("events-route", __name__)
+
+#browsers can't set headers on an EventSource, so dashboards in the admin panel can use the api_key cookie instead
+@events_route.before_request
+def events_auth():
+    with timed("auth"):
+        auth_header = request.headers.get('Authorization', "").replace("Bearer ", "")
+
+        if not key_cache.is_valid(auth_header or request.cookies.get('api_key')):
+            return jsonify({"error": "Client is unauthorized"}), 401
+
+#seconds between comments sent on a quiet stream, so proxies don't drop it and disconnected clients are noticed
+KEEPALIVE_INTERVAL = 15
+#the longest a long-poll request is held open
+MAX_POLL_TIMEOUT = 30
+
+def too_many_listeners():
+    return {"error": "Too many clients are listening for events, try again later"}, 503, {"Retry-After": "5"}
+
+#listeners don't need the database while they wait, so hand the request's connection back to the pool
+#instead of holding on to it for the whole wait
+def release_db_connection():
+    if not db.is_closed():
+        db.close()
+
+def stream_events(cursor):
+    #tells EventSource how long to wait before reconnecting if the stream drops
+    yield "retry: 3000\n\n"
+    while True:
+        events, cursor = event_hub.wait(cursor, KEEPALIVE_INTERVAL)
+        if len(events) == 0:
+            yield ": keepalive\n\n"
+        for event in events:
+            yield "id: {}\nevent: {}\ndata: {}\n\n".format(event["id"], event["type"], json.dumps(event))
+
+#streams events as Server-Sent Events: checkout, return, item, user (and reset, see EventHub)
+#picks up after Last-Event-ID (sent by EventSource when it reconnects) or ?cursor= if given, otherwise starts from now
+@events_route.get('/events')
+def get_event_stream():
+    if not event_hub.listeners.acquire(blocking=False):
+        return too_many_listeners()
+    release_db_connection()
+
+    cursor = request.headers.get('Last-Event-ID') or request.args.get('cursor') or event_hub.latest()
+    response = Response(stream_events(cursor), mimetype='text/event-stream', headers={"Cache-Control": "no-cache"})
+    #the WSGI server closes the response once the client goes away (noticed on the next write, at most KEEPALIVE_INTERVAL later)
+    response.call_on_close(event_hub.listeners.release)
+    return response
+
+#long-poll fallback for clients that can't use /events
+#returns {"events": [...], "cursor": "..."} as soon as there are events after ?cursor=, or an empty list after ?timeout= seconds
+#without a cursor, returns straight away with the cursor to start polling from
+@events_route.get('/events/poll')
+def poll_events():
+    try:
+        timeout = max(0, min(float(request.args.get('timeout', MAX_POLL_TIMEOUT)), MAX_POLL_TIMEOUT))
+    except ValueError:
+        return {"error": "timeout must be a number"}, 400
+
+    if 'cursor' not in request.args:
+        return {"events": [], "cursor": event_hub.latest()}
+
+    if not event_hub.listeners.acquire(blocking=False):
+        return too_many_listeners()
+    try:
+        release_db_connection()
+        events, cursor = event_hub.wait(request.args['cursor'], timeout)
+    finally:
+        event_hub.listeners.release()
+    return {"events": events, "cursor": cursor}
@@ -1,24 +1,124 @@
-from flask import Blueprint, request, jsonify, send_file
-from models import Image
+from flask import Blueprint, request, jsonify, send_file, Response
+from models import db, Image, ImageVariant
 from peewee import IntegrityError
 from json import dumps
-from PIL import Image as PILImage
 import io
 from middleware import auth_middleware
+from cache import image_cache, image_key
+from storage import store, image_path, read_image
+from imaging import SIZES, FULL_SIZE, make_variant
+from pipeline import image_pipeline
+from metrics import timed
+from concurrent.futures import TimeoutError
+from os import getenv
+from datetime import datetime
 
 image_route = Blueprint("image-route", __name__)
 
+#images can't be edited once they're uploaded and their IDs are never reused, so the ID (plus the size) works
+#as a strong ETag and clients are allowed to cache them forever
+IMAGE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+#how long an upload waits for its image to be processed before answering with 202 and letting the client poll
+UPLOAD_WAIT = float(getenv('IMAGE_UPLOAD_WAIT') or 2)
+
+#raised when an image was uploaded but the pipeline hasn't finished with it yet
+class ImageNotReady(Exception):
+    pass
+
+#finds the row holding an image at the given size
+#images uploaded before sizes existed only have the full size, so smaller ones are made the first time they're asked for
+def get_sized_row(id, size):
+    if size == FULL_SIZE:
+        image = Image.select(Image.image, Image.digest, Image.status).where(Image.id == id).get()
+        if image.status != "ready":
+            raise ImageNotReady()
+        return image
+
+    try:
+        return ImageVariant.select(ImageVariant.image, ImageVariant.digest).where(
+            (ImageVariant.image_id == id) & (ImageVariant.size == size)
+        ).get()
+    except ImageVariant.DoesNotExist:
+        original = Image.get(Image.id == id)
+        if original.status != "ready":
+            raise ImageNotReady()
+        variant = ImageVariant(image_id=original, size=size)
+        with timed("image"):
+            store.write(variant, make_variant(read_image(original), size))
+        try:
+            with db.atomic():
+                variant.save(force_insert=True)
+        except IntegrityError:
+            #another request made the same size at the same time, which is fine since they're identical
+            pass
+        return variant
+
+def image_response(key, **kwargs):
+    response = send_file(mimetype='image/jpeg', etag=key, conditional=False, **kwargs)
+    response.headers['Cache-Control'] = IMAGE_CACHE_CONTROL
+    return response
+
+#returns an image as a JPEG. Takes an optional ?size=, which has to be one of the sizes in imaging.SIZES
 @image_route.get('/image/<id>')
 def get_item(id):
+    size = request.args.get('size', FULL_SIZE, type=int)
+    if size not in SIZES:
+        return {"error": "Size must be one of {}".format(", ".join(str(s) for s in sorted(SIZES)))}, 400
+
+    key = image_key(id, size)
+
+    try:
+        #clients that already have this image get a 304 without the blob ever being pulled out of the database
+        #the image is still looked up first, so one that was deleted gets a 404 instead
+        if request.if_none_match.contains(key):
+            if Image.select(Image.status).where(Image.id == id).get().status != "ready":
+                raise ImageNotReady()
+            response = Response(status=304)
+            response.set_etag(key)
+            response.headers['Cache-Control'] = IMAGE_CACHE_CONTROL
+            return response
+
+        data = image_cache.get(key)
+        if data is None:
+            row = get_sized_row(id, size)
+
+            #images on disk are handed straight to the WSGI server, which can sendfile them without copying
+            #the OS page cache already keeps popular files in memory, so they skip the image cache
+            path = image_path(row)
+            if path is not None:
+                return image_response(key, path_or_file=path)
+
+            data = read_image(row)
+            image_cache.put(key, data)
+
+        return image_response(key, path_or_file=io.BytesIO(data))
+    except Image.DoesNotExist:
+        return jsonify({"error": "Image does not exist"}), 404
+    except ImageNotReady:
+        return jsonify({"error": "Image is still being processed"}), 404
+    except Exception as e:
+        return {"error": str(e), "type": type(e).__name__}, 500
+
+#lets uploaders poll for an image that was still processing when the upload returned
+#status is one of "processing", "ready" or "failed"
+@image_route.get('/image/<id>/status')
+def get_status(id):
     try:
-        img = Image.get(Image.id == id)
-        return send_file(io.BytesIO(img.image), mimetype='image/jpeg')
+        return Image.select(Image.id, Image.status).where(Image.id == id).dicts().get()
     except Image.DoesNotExist:
         return jsonify({"error": "Image does not exist"}), 404
     except Exception as e:
         return {"error": str(e), "type": type(e).__name__}, 500
 
-    return jsonify(list(items))
+#hit/miss/eviction counters for the server-side image cache
+@image_route.get('/image/cache')
+def get_cache_stats():
+    auth = auth_middleware()
+    if auth is not None:
+        return auth
+
+    return image_cache.stats()
 
 @image_route.post('/image')
 def put_image():
@@ -27,28 +127,36 @@ def put_image():
     if auth is not None:
         return auth
 
+    #turns uploads away while the processing queue is full, rather than letting them pile up
+    if not image_pipeline.reserve():
+        return {"error": "The server is busy processing other images, try again shortly"}, 503, {"Retry-After": "5"}
+
+    new_image = Image(status="processing")
     try:
-        f = request.files['file']
-        
-        img = PILImage.open(f)
-        #scales image down to have a height of 400 px but a preserved aspect ratio
-        ratio = img.width / img.height
-        cropped_img = img.resize((int(400*ratio), 400))
-
-        #converts image to 400x400 and centers it
-        mid_x = int(cropped_img.width/2)
-        mid_y = int(cropped_img.height/2)
-        cropped_img = cropped_img.crop((mid_x-200, mid_y-200, mid_x+200, mid_y+200))
-        
-        img_byte_arr = io.BytesIO()
-        cropped_img.save(img_byte_arr, format='JPEG')
-
-        new_image = Image(image=img_byte_arr.getvalue())
+        data = request.files['file'].read()
+
+        #the row is saved first so its ID can be handed out straight away, the image itself is filled in
+        #once the pipeline has made a square, center cropped JPEG of it at every size the clients use
         new_image.save(force_insert=True)
-        return {'id': new_image.id}
-    except AttributeError as e:
+        stored = image_pipeline.submit(new_image.id, data)
+    except KeyError:
+        image_pipeline.release()
         return {"error": "Missing information to create this object"}, 400
-    except IntegrityError as e:
-        return {"error": "This image already exists in the system"}, 400
     except Exception as e:
-        return {"error": str(e), "type": type(e).__name__}, 500
\ No newline at end of file
+        image_pipeline.release()
+        #don't leave a row behind that looks like it will finish processing some day
+        Image.update(status="failed", updated_at=datetime.now()).where(Image.id == new_image.id).execute()
+        return {"error": str(e), "type": type(e).__name__}, 500
+
+    try:
+        with timed("image"):
+            stored.result(timeout=UPLOAD_WAIT)
+        return {'id': new_image.id, 'status': "ready"}
+    except TimeoutError:
+        #still working on it, the client can poll /image/<id>/status
+        return {'id': new_image.id, 'status': "processing"}, 202
+    except OSError as e:
+        #Pillow raises this for files that aren't images it understands
+        return {"error": "This file could not be read as an image", "id": new_image.id, "status": "failed"}, 400
+    except Exception as e:
+        return {"error": str(e), "type": type(e).__name__}, 500
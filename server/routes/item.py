@@ -1,24 +1,92 @@
-from flask import Blueprint, request, jsonify
-from models import Item
+from flask import Blueprint, request, jsonify, json, Response, stream_with_context
+from models import db, Item
 from peewee import IntegrityError
+from playhouse.postgres_ext import ServerSide
 from json import dumps
 from datetime import datetime
 from middleware import auth_middleware
+from events import item_event
 
 item_route = Blueprint("item-route", __name__)
 item_route.before_request(auth_middleware)
 
+#the most rows a single page can ask for with ?limit=
+MAX_PAGE_SIZE = 1000
+#rows are written out in groups of this many, so the WSGI server isn't handed one tiny chunk per row
+STREAM_CHUNK_SIZE = 100
+
+#builds the item query from the request's filters, all of which are applied in SQL
+#  barcode, name, area: exact matches
+#  has_image: true/false, whether the item has an image attached
+#  after: only items with an ID greater than this one (the X-Next-After header from the previous page)
+def build_item_query(args):
+    query = Item.select().order_by(Item.id)
+
+    if 'barcode' in args:
+        query = query.where(Item.barcode == args['barcode'])
+    if 'name' in args:
+        query = query.where(Item.name == args['name'])
+    if 'area' in args:
+        query = query.where(Item.area == int(args['area']))
+    if 'has_image' in args:
+        if args['has_image'].lower() in ('1', 'true', 'yes'):
+            query = query.where(Item.image.is_null(False))
+        else:
+            query = query.where(Item.image.is_null())
+    if 'after' in args:
+        query = query.where(Item.id > args['after'])
+
+    return query.dicts()
+
+#writes rows out as either a JSON list or newline delimited JSON (one item per line) as the cursor hands them over
+def stream_items(rows, ndjson):
+    chunk = []
+    first = True
+    if not ndjson:
+        yield "["
+
+    for row in rows:
+        if ndjson:
+            chunk.append(json.dumps(row) + "\n")
+        else:
+            chunk.append(("" if first else ",") + json.dumps(row))
+            first = False
+
+        if len(chunk) >= STREAM_CHUNK_SIZE:
+            yield "".join(chunk)
+            chunk = []
+
+    yield "".join(chunk)
+    if not ndjson:
+        yield "]"
+
+#lists items, see build_item_query for the filters
+#with ?limit=, returns one page of at most MAX_PAGE_SIZE items and sets X-Next-After if there are more to fetch
+#without it, every matching item is streamed straight from a server-side cursor without loading them all at once
+#?format=ndjson returns one JSON object per line instead of a JSON list
 @item_route.get('/item')
 def get_item():
-    if (len(request.args.to_dict()) > 0):
-        items = Item.select().where(
-            Item.barcode == request.args.get('barcode') or
-            Item.name == request.args.get('name')
-        ).dicts()
-    else:
-        items = Item.select().dicts()
+    try:
+        query = build_item_query(request.args)
+        limit = request.args.get('limit')
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE)) if limit is not None else None
+    except ValueError:
+        return {"error": "area and limit must be numbers"}, 400
+
+    ndjson = request.args.get('format') == 'ndjson'
+    mimetype = 'application/x-ndjson' if ndjson else 'application/json'
+
+    if limit is not None:
+        #asks for one extra row to find out if there's another page without a separate count query
+        rows = list(query.limit(limit + 1))
+        headers = {}
+        if len(rows) > limit:
+            rows = rows[:limit]
+            headers['X-Next-After'] = rows[-1]['id']
+        return Response(stream_items(rows, ndjson), mimetype=mimetype, headers=headers)
 
-    return jsonify(list(items))
+    #stream_with_context keeps the request (and its database connection) open until the last row is written
+    return Response(stream_with_context(stream_items(ServerSide(query), ndjson)), mimetype=mimetype)
 
 @item_route.post('/item')
 def put_item():
@@ -33,7 +101,9 @@ def put_item():
             new_item.description = body['description']
         if "last-calibration" in body and body["last-calibration"] != "":
             new_item.last_calibration = datetime.strptime(body['last-calibration'], "%Y-%m-%d")
-        new_item.save(force_insert=True)
+        with db.atomic():
+            new_item.save(force_insert=True)
+            item_event(new_item)
         return {'id': new_item.id}
     except AttributeError as e:
         return {"error": "Missing information to create this object"}, 400
@@ -0,0 +1,29 @@
+from flask import Blueprint, Response
+from models import db
+from cache import image_cache
+from metrics import metrics
+from middleware import auth_middleware
+
+metrics_route = Blueprint("metrics-route", __name__)
+metrics_route.before_request(auth_middleware)
+
+#the request metrics plus a few gauges that are read when they're asked for
+#point Prometheus at this with the API key as its bearer token
+@metrics_route.get('/metrics')
+def get_metrics():
+    lines = [metrics.render()]
+
+    lines.append("# HELP lmao_db_pool_connections Database connections held by this process, by whether they're checked out")
+    lines.append("# TYPE lmao_db_pool_connections gauge")
+    lines.append('lmao_db_pool_connections{{state="in_use"}} {}'.format(len(db._in_use)))
+    lines.append('lmao_db_pool_connections{{state="idle"}} {}'.format(len(db._connections)))
+
+    stats = image_cache.stats()
+    lines.append("# HELP lmao_image_cache_bytes Bytes of images held in the image cache")
+    lines.append("# TYPE lmao_image_cache_bytes gauge")
+    lines.append("lmao_image_cache_bytes {}".format(stats["bytes"]))
+    for counter in ["hits", "misses", "evictions"]:
+        lines.append("# TYPE lmao_image_cache_{}_total counter".format(counter))
+        lines.append("lmao_image_cache_{}_total {}".format(counter, stats[counter]))
+
+    return Response("\n".join(lines) + "\n", mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,104 @@
+from flask import Blueprint, request, jsonify, Response, stream_with_context
+from models import Checkout, Item, ItemUsage
+from peewee import fn
+from playhouse.postgres_ext import ServerSide
+from datetime import datetime
+import csv
+import io
+from middleware import auth_middleware
+from reports import usage_refreshed_at, overdue_query, calibration_query, due_list, LOAN_DAYS, CALIBRATION_DAYS
+
+report_route = Blueprint("report-route", __name__)
+report_route.before_request(auth_middleware)
+
+#rows are written out in groups of this many, same as STREAM_CHUNK_SIZE in routes/item.py
+CSV_CHUNK_SIZE = 100
+
+#every report returns a JSON list by default, or a CSV file with ?format=csv
+#both are written out as the rows come off a server-side cursor, so big reports are never held in memory
+def report_response(name, columns, query):
+    if request.args.get('format') == 'csv':
+        headers = {"Content-Disposition": "attachment; filename={}-{}.csv".format(name, datetime.now().strftime("%Y-%m-%d"))}
+        body = stream_csv(columns, ServerSide(query.dicts()))
+        return Response(stream_with_context(body), mimetype='text/csv', headers=headers)
+    return jsonify(list(query.dicts()))
+
+def stream_csv(columns, rows):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=columns, extrasaction='ignore')
+    writer.writeheader()
+
+    for count, row in enumerate(rows, start=1):
+        writer.writerow(row)
+        if count % CSV_CHUNK_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def days(seconds):
+    return seconds / 86400
+
+#checkout totals for every item, most checked out first. Comes from item_usage (see reports.py),
+#so it can be up to REPORT_REFRESH_INTERVAL seconds behind, the X-Refreshed-At header says how old it is
+#?limit= returns only the top items
+@report_route.get('/report/usage')
+def get_usage_report():
+    try:
+        limit = int(request.args['limit']) if 'limit' in request.args else None
+    except ValueError:
+        return {"error": "limit must be a number"}, 400
+
+    average = fn.COALESCE(ItemUsage.loan_seconds / fn.NULLIF(ItemUsage.returns, 0), 0)
+    query = (ItemUsage
+             .select(Item.id, Item.barcode, Item.name, Item.area, ItemUsage.checkouts, ItemUsage.returns,
+                     days(average).alias('average_loan_days'), ItemUsage.last_checkout)
+             .join(Item)
+             .order_by(ItemUsage.checkouts.desc(), Item.id))
+    if limit is not None:
+        query = query.limit(limit)
+
+    columns = ['id', 'barcode', 'name', 'area', 'checkouts', 'returns', 'average_loan_days', 'last_checkout']
+    response = report_response('usage', columns, query)
+    refreshed_at = usage_refreshed_at()
+    if refreshed_at is not None:
+        response.headers['X-Refreshed-At'] = refreshed_at.isoformat()
+    return response
+
+#lab wide totals from item_usage, plus how many checkouts are overdue right now
+@report_route.get('/report/summary')
+def get_summary_report():
+    totals = ItemUsage.select(
+        fn.COALESCE(fn.SUM(ItemUsage.checkouts), 0).alias('checkouts'),
+        fn.COALESCE(fn.SUM(ItemUsage.returns), 0).alias('returns'),
+        fn.COALESCE(fn.SUM(ItemUsage.loan_seconds), 0).alias('loan_seconds')
+    ).dicts().get()
+
+    refreshed_at = usage_refreshed_at()
+    return {
+        "checkouts": totals['checkouts'],
+        "returns": totals['returns'],
+        "average_loan_days": days(totals['loan_seconds'] / totals['returns']) if totals['returns'] > 0 else 0,
+        "open": Checkout.select().where(Checkout.return_date.is_null()).count(),
+        "overdue": overdue_query().count(),
+        "loan_days": LOAN_DAYS,
+        "refreshed_at": refreshed_at.isoformat() if refreshed_at is not None else None
+    }
+
+#checkouts that have been open for more than LOAN_DAYS days, oldest first
+@report_route.get('/report/overdue')
+def get_overdue_report():
+    columns = ['id', 'start_date', 'barcode', 'item_name', 'area', 'gtid', 'user_name', 'email']
+    return report_response('overdue', columns, overdue_query())
+
+#items that haven't been calibrated in more than CALIBRATION_DAYS days, the ones that warn on every checkout
+@report_route.get('/report/calibration')
+def get_calibration_report():
+    columns = ['id', 'barcode', 'name', 'area', 'last_calibration']
+    return report_response('calibration', columns, calibration_query(CALIBRATION_DAYS))
+
+#overdue and soon to be due calibrations and overdue loans, as of the last background scan (see scan_due)
+#answered from memory, so dashboards can ask for it as often as they like
+@report_route.get('/report/due')
+def get_due_report():
+    return jsonify(due_list.get())
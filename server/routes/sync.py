@@ -0,0 +1,81 @@
+from flask import Blueprint, request, json, Response, stream_with_context
+from models import Item, User, Image, Tombstone, TOMBSTONE_RETENTION
+from playhouse.postgres_ext import ServerSide
+from datetime import datetime, timedelta
+import base64
+from middleware import auth_middleware
+
+sync_route = Blueprint("sync-route", __name__)
+sync_route.before_request(auth_middleware)
+
+#the columns sent for each table clients can sync. Images only send their status, the pictures themselves come from /image/<id>
+SYNC_TABLES = {
+    "items": (Item, [Item.id, Item.barcode, Item.name, Item.area, Item.image, Item.description, Item.last_calibration, Item.updated_at]),
+    "users": (User, [User.id, User.gtid, User.name, User.email, User.updated_at]),
+    "images": (Image, [Image.id, Image.status, Image.updated_at])
+}
+
+#updated_at is set when a row is saved, but the row only shows up once its transaction commits, which can be a moment later
+#cursors are moved back by this much so rows that commit late are still picked up (and sent twice, which is harmless)
+SYNC_OVERLAP = timedelta(seconds=5)
+
+#cursors are just a timestamp, but clients should treat them as opaque so this can change later
+def encode_cursor(when):
+    return base64.urlsafe_b64encode(when.isoformat().encode()).decode()
+
+def decode_cursor(cursor):
+    return datetime.fromisoformat(base64.urlsafe_b64decode(cursor.encode()).decode())
+
+#writes out every change since the cursor as newline delimited JSON, one change per line:
+#  {"table": "items", "row": {...}}         a row that was added or changed
+#  {"table": "items", "deleted": "<id>"}    a row that was deleted
+#  {"cursor": "..."}                        always last, pass it back as ?cursor= next time
+#and if the cursor was too old to know what was deleted since, this comes first and the rest is every row:
+#  {"reset": true}                          drop anything the response doesn't mention
+def stream_changes(tables, since, next_cursor, reset):
+    if reset:
+        yield json.dumps({"reset": True}) + "\n"
+
+    for name in tables:
+        model, fields = SYNC_TABLES[name]
+
+        query = model.select(*fields).order_by(model.updated_at).dicts()
+        if since is not None:
+            query = query.where(model.updated_at > since)
+        for row in ServerSide(query):
+            yield json.dumps({"table": name, "row": row}) + "\n"
+
+        #a client without a cursor is getting everything, so it has nothing to delete
+        if since is not None:
+            deleted = Tombstone.select(Tombstone.row_id).where(
+                (Tombstone.table == model._meta.table_name) & (Tombstone.deleted_at > since)
+            ).tuples()
+            for (row_id,) in ServerSide(deleted):
+                yield json.dumps({"table": name, "deleted": row_id}) + "\n"
+
+    yield json.dumps({"cursor": next_cursor}) + "\n"
+
+#returns the rows that changed since ?cursor= (or every row if there is no cursor) as newline delimited JSON
+#?tables= picks which tables to send, as a comma separated list (defaults to all of items, users and images)
+@sync_route.get('/sync')
+def get_changes():
+    try:
+        tables = request.args.get('tables', ",".join(SYNC_TABLES)).split(",")
+        if any(t not in SYNC_TABLES for t in tables):
+            return {"error": "tables must be some of {}".format(", ".join(SYNC_TABLES))}, 400
+
+        since = decode_cursor(request.args['cursor']) if request.args.get('cursor') else None
+    except ValueError:
+        return {"error": "Invalid cursor"}, 400
+
+    #worked out before reading anything, so nothing that changes while the response is being written gets skipped
+    now = datetime.now()
+    next_cursor = encode_cursor(now - SYNC_OVERLAP)
+
+    #tombstones older than this have been pruned, so deletions since the cursor may be missing. Everything is sent instead
+    reset = since is not None and since < now - TOMBSTONE_RETENTION
+    if reset:
+        since = None
+
+    #stream_with_context keeps the request (and its database connection) open until the last row is written
+    return Response(stream_with_context(stream_changes(tables, since, next_cursor, reset)), mimetype='application/x-ndjson')
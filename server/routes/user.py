@@ -1,7 +1,9 @@
 from flask import Blueprint, request, jsonify
 from peewee import DoesNotExist, IntegrityError, JOIN
-from models import User, Checkout, Item
+from models import db, User, Checkout, Item, PreparedStatement
+from datetime import datetime
 from middleware import auth_middleware
+from events import user_event
 
 user_route = Blueprint("user-route", __name__)
 user_route.before_request(auth_middleware)
@@ -28,7 +30,9 @@ def put_user():
         new_user = User(gtid=body["gtid"], name=body["name"])
         if "email" in body:
             new_user.email = body['email']
-        new_user.save(force_insert=True)
+        with db.atomic():
+            new_user.save(force_insert=True)
+            user_event(new_user)
         return {"id": new_user.id}
     except KeyError:
         return {"error": "Missing required information to create this user"}, 400
@@ -37,6 +41,48 @@ def put_user():
     except Exception as e:
         return {"error": str(e), "type": type(e).__name__}, 500
 
+#everything a terminal needs when a badge is tapped in one query: the user, how many items they have out and what those are
+#(the same as /user and /user/items together). The open checkouts are added up into a JSON list by Postgres
+LOGIN_SQL = """
+SELECT u.id, u.gtid, u.name, u.email, u.updated_at, COUNT(c.id) AS open_count,
+       COALESCE(json_agg(json_build_object(
+           'start_date', to_char(c.start_date, 'YYYY-MM-DD"T"HH24:MI:SS.US'), 'name', i.name, 'barcode', i.barcode, 'area', i.area, 'image', i.image_id
+       ) ORDER BY c.start_date) FILTER (WHERE c.id IS NOT NULL), '[]') AS items
+FROM users u
+LEFT JOIN checkouts c ON c.user_id = u.id AND c.return_date IS NULL
+LEFT JOIN items i ON i.id = c.item_id
+WHERE u.gtid = $1
+GROUP BY u.id
+"""
+#it runs on every badge tap, so it's only planned once per connection
+login_statement = PreparedStatement("user_login", ["text"], LOGIN_SQL)
+
+#turns a row from LOGIN_SQL into {"user": {...}, "open_count": ..., "items": [...]}
+#start_date comes back from json_agg as an ISO string, it's turned back into a datetime so it's formatted like /user/items
+#LOGIN_SQL always gives it six digits of microseconds, since Postgres drops trailing zeros and fromisoformat
+#only takes exactly three or six before Python 3.11
+def login_response(row):
+    *user, open_count, items = row
+    for item in items:
+        item['start_date'] = datetime.fromisoformat(item['start_date'])
+    return {
+        "user": dict(zip(["id", "gtid", "name", "email", "updated_at"], user)),
+        "open_count": open_count,
+        "items": items
+    }
+
+@user_route.get('/user/login')
+def login_user():
+    try:
+        row = login_statement.execute(request.args['gtid']).fetchone()
+        if row is None:
+            return {"error": "User does not exist"}, 404
+        return login_response(row)
+    except KeyError:
+        return {"error": "Missing GT id"}, 400
+    except Exception as e:
+        return {"error": str(e), "type": type(e).__name__}, 500
+
 @user_route.get('/user/items')
 def get_user_items():
     try:
@@ -4,4 +4,4 @@ set POSTGRES_USER=postgres
 set POSTGRES_PASSWORD=(passwd)
 set POSTGRES_HOST=localhost
 
-python -m waitress --port 80 --call "lmao_server:create_app"
\ No newline at end of file
+python -m waitress --port 80 --threads 16 --call "lmao_server:create_app"
\ No newline at end of file
@@ -0,0 +1,7 @@
+set FLASK_APP=server/lmao_server.py
+set FLASK_ENV=production
+set POSTGRES_USER=postgres
+set POSTGRES_PASSWORD=(passwd)
+set POSTGRES_HOST=localhost
+
+python -m uvicorn --factory asgi_server:create_asgi_app --host 0.0.0.0 --port 80
@@ -0,0 +1,40 @@
+from threading import Thread, Lock
+import time
+from models import db
+
+#Runs jobs every so often on one background thread, each with its own database connection.
+#Jobs that take longer than their interval just run again as soon as they finish, they're never run twice at once
+class Scheduler():
+    def __init__(self):
+        #each job is [function, seconds between runs, next run time]
+        self.jobs = []
+        self.thread = None
+        self.lock = Lock()
+
+    #the job is run for the first time as soon as the scheduler starts
+    def every(self, seconds, job):
+        with self.lock:
+            self.jobs.append([job, seconds, 0])
+
+    def start(self):
+        with self.lock:
+            if self.thread is None and len(self.jobs) > 0:
+                self.thread = Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            with self.lock:
+                entry = min(self.jobs, key=lambda j: j[2])
+            wait = entry[2] - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+
+            try:
+                with db.connection_context():
+                    entry[0]()
+            except Exception as e:
+                print("Scheduled job {} failed: {}".format(entry[0].__name__, e))
+            entry[2] = time.monotonic() + entry[1]
+
+scheduler = Scheduler()
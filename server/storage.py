@@ -0,0 +1,64 @@
+from os import getenv
+import os
+import hashlib
+import tempfile
+
+#Image rows hold their bytes in one of two places:
+# - image: the JPEG itself, stored in Postgres (the original behaviour)
+# - digest: the sha256 of the JPEG, which is stored on disk by FileStore
+#Rows are read from wherever their bytes actually are, so both kinds can live side by side
+#while an existing database is being moved over with `python migrate.py images`
+
+#keeps the image bytes in the database row
+class DatabaseStore():
+    def write(self, row, data):
+        row.image = data
+        row.digest = None
+
+#keeps the image bytes on disk, content addressed by their sha256 so identical uploads share a file
+#files are fanned out into subfolders by the first two characters of the hash to keep folders small
+class FileStore():
+    def __init__(self, root):
+        self.root = root
+
+    def path_for(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def write(self, row, data):
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path_for(digest)
+
+        if not os.path.exists(path):
+            folder = os.path.dirname(path)
+            os.makedirs(folder, exist_ok=True)
+            #write to a temporary file first and move it into place, so a half-written file is never served
+            fd, tmp_path = tempfile.mkstemp(dir=folder)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except:
+                os.remove(tmp_path)
+                raise
+
+        row.digest = digest
+        row.image = None
+
+file_store = FileStore(os.path.abspath(getenv('IMAGE_STORE_PATH') or 'images'))
+
+#the store new uploads are written to, set IMAGE_STORE=database to keep images in Postgres
+store = DatabaseStore() if getenv('IMAGE_STORE') == 'database' else file_store
+
+#returns the path on disk for a row, or None if its bytes are in the database
+def image_path(row):
+    if row.digest is None:
+        return None
+    return file_store.path_for(row.digest)
+
+#returns the bytes of an image no matter where they are stored
+def read_image(row):
+    path = image_path(row)
+    if path is None:
+        return bytes(row.image)
+    with open(path, 'rb') as f:
+        return f.read()
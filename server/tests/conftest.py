@@ -0,0 +1,132 @@
+import os
+import json
+import select
+import sys
+import tempfile
+import uuid
+from contextlib import contextmanager
+import psycopg2
+import pytest
+
+#Tests run against a throwaway database on the Postgres from POSTGRES_USER/PASSWORD/HOST, like bench.py,
+#and are skipped if it can't be reached. Run them from ./server:
+#
+#   python -m pytest tests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+#has to be set before the server modules are imported, since they read it when they load
+DATABASE = "lmao_test_{}".format(uuid.uuid4().hex[:8])
+os.environ['POSTGRES_DB'] = DATABASE
+os.environ.setdefault('IMAGE_STORE_PATH', tempfile.mkdtemp(prefix="lmao-test-images-"))
+#background jobs would run queries in the middle of the ones being counted
+os.environ['REPORT_REFRESH_INTERVAL'] = '0'
+os.environ['DUE_SCAN_INTERVAL'] = '0'
+os.environ['IMAGE_CACHE_WARM'] = '0'
+os.environ['TOMBSTONE_PRUNE_INTERVAL'] = '0'
+
+from bench import run_admin_sql
+
+@pytest.fixture(scope="session")
+def app():
+    try:
+        run_admin_sql('CREATE DATABASE "{}"'.format(DATABASE))
+    except psycopg2.OperationalError as e:
+        pytest.skip("Postgres can't be reached: {}".format(e))
+
+    #create_app writes a first API key to ./key on an empty database, keep that out of ./server
+    cwd = os.getcwd()
+    os.chdir(tempfile.mkdtemp(prefix="lmao-test-"))
+    try:
+        from lmao_server import create_app
+        app = create_app()
+        app.config['TESTING'] = True
+        yield app
+    finally:
+        from models import db
+        from events import event_hub
+        event_hub.stop()
+        db.close_all()
+        run_admin_sql('DROP DATABASE IF EXISTS "{}"'.format(DATABASE))
+        os.chdir(cwd)
+
+@pytest.fixture(scope="session")
+def api_key(app):
+    from models import db, ApiKey
+    with db.connection_context():
+        return ApiKey.create().code
+
+#a test client that sends the API key both ways the server accepts it, as a Bearer token and as the admin panel's cookie
+@pytest.fixture
+def client(app, api_key):
+    client = app.test_client()
+    client.environ_base["HTTP_AUTHORIZATION"] = "Bearer {}".format(api_key)
+    client.set_cookie("localhost", "api_key", api_key)
+    #the key is cached after the first lookup, so it isn't counted by the tests
+    assert client.get("/ping").status_code == 200
+    return client
+
+#counts every query the server runs inside the block: `with count_queries() as queries:` gives a list of their SQL
+@pytest.fixture
+def count_queries(app, monkeypatch):
+    from models import db
+
+    @contextmanager
+    def counting():
+        queries = []
+        execute_sql = db.execute_sql
+
+        def counted(sql, *args, **kwargs):
+            queries.append(sql)
+            return execute_sql(sql, *args, **kwargs)
+
+        with monkeypatch.context() as m:
+            m.setattr(db, "execute_sql", counted)
+            yield queries
+    return counting
+
+#empties the tables the tests fill, then adds n users with one open checkout each, each of a different item
+#returns the users and items that were made
+@pytest.fixture
+def seed(app):
+    from models import db, gen_uuid, Item, User, Checkout
+
+    def seeding(n):
+        with db.connection_context():
+            db.execute_sql("TRUNCATE checkouts, items, users, tombstones CASCADE")
+            users = [{"id": gen_uuid(), "gtid": str(900000000 + i), "name": "User {}".format(i)} for i in range(n)]
+            items = [{"id": gen_uuid(), "barcode": str(100000000 + i), "name": "Item {}".format(i)} for i in range(n)]
+            User.insert_many(users).execute()
+            Item.insert_many(items).execute()
+            Checkout.insert_many([
+                {"id": gen_uuid(), "item_id": item["id"], "user_id": user["id"]} for user, item in zip(users, items)
+            ]).execute()
+        return users, items
+    return seeding
+
+#events published with NOTIFY, heard on a connection of the test's own
+class EventListener():
+    def __init__(self, conn):
+        self.conn = conn
+
+    def clear(self):
+        self.received()
+
+    #every event that arrived so far
+    def received(self):
+        events = []
+        while select.select([self.conn], [], [], 0.2) != ([], [], []):
+            self.conn.poll()
+            while self.conn.notifies:
+                events.append(json.loads(self.conn.notifies.pop(0).payload))
+        return events
+
+@pytest.fixture
+def events(app):
+    from models import db
+    from events import EVENT_CHANNEL
+    conn = psycopg2.connect(dbname=db.database, **db.connect_params)
+    conn.autocommit = True
+    conn.cursor().execute("LISTEN {}".format(EVENT_CHANNEL))
+    yield EventListener(conn)
+    conn.close()
@@ -0,0 +1,14 @@
+from cache import KeyCache
+
+def test_key_revoked_during_lookup_is_not_cached():
+    cache = KeyCache(ttl=300, negative_ttl=30, max_entries=10)
+    #a lookup starts, then the key is revoked before its answer comes back
+    generation = cache.generation
+    cache.invalidate("revoked")
+    cache.remember("revoked", True, generation)
+    assert cache.cached("revoked") is None
+
+def test_lookup_is_cached():
+    cache = KeyCache(ttl=300, negative_ttl=30, max_entries=10)
+    cache.remember("key", True, cache.generation)
+    assert cache.cached("key") is True
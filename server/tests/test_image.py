@@ -0,0 +1,12 @@
+from models import db, Image
+
+def test_cached_copy_of_deleted_image(client):
+    response = client.get("/image/deleted-image-id", headers={"If-None-Match": '"deleted-image-id"'})
+    assert response.status_code == 404
+
+def test_cached_copy_of_image(client):
+    with db.connection_context():
+        image = Image.create(status="ready")
+    response = client.get("/image/{}?size=100".format(image.id), headers={"If-None-Match": '"{}-100"'.format(image.id)})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == '"{}-100"'.format(image.id)
@@ -0,0 +1,56 @@
+import pytest
+from datetime import datetime
+from bench import run_admin_sql
+
+#/user/login answers with what /user and /user/items give separately
+def expected_login(client, gtid):
+    user = client.get("/user", query_string={"gtid": gtid}).get_json()
+    items = client.get("/user/items", query_string={"gtid": gtid}).get_json()
+    return {"user": user, "open_count": len(items), "items": items}
+
+#gives the first user n open checkouts, of the first n items
+def give_checkouts(client, users, items, n):
+    barcodes = [i["barcode"] for i in items]
+    client.delete("/checkout/bulk", json={"gtid": users[0]["gtid"], "barcodes": barcodes})
+    for barcode in barcodes[:n]:
+        assert client.post("/checkout", json={"gtid": users[0]["gtid"], "barcode": barcode}).status_code == 200
+
+@pytest.mark.parametrize("n", [0, 1, 5])
+def test_login(client, seed, n):
+    users, items = seed(5)
+    give_checkouts(client, users, items, n)
+
+    response = client.get("/user/login", query_string={"gtid": users[0]["gtid"]})
+    assert response.status_code == 200, response.get_json()
+    login = response.get_json()
+    assert login == expected_login(client, users[0]["gtid"])
+    assert [i["barcode"] for i in login["items"]] == [i["barcode"] for i in items[:n]]
+
+def test_login_missing_user(client, seed):
+    seed(1)
+    assert client.get("/user/login", query_string={"gtid": "123"}).status_code == 404
+    assert client.get("/user/login").status_code == 400
+
+#start dates with trailing zeros in their microseconds still come out like /user/items
+def test_login_response():
+    from routes.user import login_response
+    row = ("id", "900000000", "User 0", None, datetime(2024, 1, 2), 2, [
+        {"start_date": "2024-01-02T03:04:05.000000", "name": "Item 0", "barcode": "100000000", "area": 1, "image": None},
+        {"start_date": "2024-01-02T03:04:05.120000", "name": "Item 1", "barcode": "100000001", "area": 1, "image": None}
+    ])
+    response = login_response(row)
+    assert response["user"] == {"id": "id", "gtid": "900000000", "name": "User 0", "email": None, "updated_at": datetime(2024, 1, 2)}
+    assert response["open_count"] == 2
+    assert [i["start_date"] for i in response["items"]] == [datetime(2024, 1, 2, 3, 4, 5), datetime(2024, 1, 2, 3, 4, 5, 120000)]
+
+#when Postgres drops the connection, the query is retried on a new one that the statement has to be prepared on first
+def test_login_after_reconnect(client, seed):
+    from models import db
+    users, items = seed(1)
+    expected = expected_login(client, users[0]["gtid"])
+    assert client.get("/user/login", query_string={"gtid": users[0]["gtid"]}).status_code == 200
+
+    run_admin_sql("SELECT pg_terminate_backend(pid) FROM pg_stat_activity WHERE datname = '{}'".format(db.database))
+    response = client.get("/user/login", query_string={"gtid": users[0]["gtid"]})
+    assert response.status_code == 200, response.get_json()
+    assert response.get_json() == expected
@@ -0,0 +1,80 @@
+import pytest
+
+#Each of these loads everything it needs in a fixed number of queries, no matter how many rows there are.
+#A query per row (i.e. loading each checkout's user on its own) shows up here as a count that grows with n
+
+#the checkouts admin page shows 20 rows at a time
+@pytest.mark.parametrize("n", [1, 20])
+def test_checkout_admin_list(client, seed, count_queries, n):
+    seed(n)
+    with count_queries() as queries:
+        response = client.get("/admin/checkout/")
+    assert response.status_code == 200
+    #the row count for the pager, then the rows with their items and users
+    assert len(queries) == 2, queries
+
+@pytest.mark.parametrize("n", [1, 20])
+def test_create_checkout(client, seed, count_queries, n):
+    users, items = seed(n + 1)
+    #the last item is returned first so it's free to check out
+    client.delete("/checkout", json={"gtid": users[-1]["gtid"], "barcode": items[-1]["barcode"]})
+
+    with count_queries() as queries:
+        response = client.post("/checkout", json={"gtid": users[0]["gtid"], "barcode": items[-1]["barcode"]})
+    assert response.status_code == 200, response.get_json()
+    #the user, the item, its open checkout, the insert and the event
+    assert len(queries) == 5, queries
+
+@pytest.mark.parametrize("n", [1, 20])
+def test_create_checkout_already_out(client, seed, count_queries, n):
+    users, items = seed(n + 1)
+
+    with count_queries() as queries:
+        response = client.post("/checkout", json={"gtid": users[0]["gtid"], "barcode": items[-1]["barcode"]})
+    assert response.status_code == 403
+    assert response.get_json()["error"] == "This item is already checked out by {}".format(users[-1]["name"])
+    #the user, the item and its open checkout with the owner's name
+    assert len(queries) == 3, queries
+
+@pytest.mark.parametrize("n", [1, 20])
+def test_delete_checkout(client, seed, count_queries, n):
+    users, items = seed(n)
+
+    with count_queries() as queries:
+        response = client.delete("/checkout", json={"gtid": users[0]["gtid"], "barcode": items[-1]["barcode"]})
+    assert response.status_code == 200, response.get_json()
+    if n > 1:
+        #returned by someone else, so the owner's name comes back too
+        assert response.get_json()["message"] == "This item is returned for {}".format(users[-1]["name"])
+    #the open checkout with its item and user, the update and the event
+    assert len(queries) == 3, queries
+
+#a whole cart is checked out or returned in the same number of queries however many items are in it
+@pytest.mark.parametrize("n", [1, 20])
+def test_bulk_checkout(client, seed, count_queries, events, n):
+    users, items = seed(n + 1)
+    #frees up every item but the first one's
+    barcodes = [i["barcode"] for i in items[1:]]
+    client.delete("/checkout/bulk", json={"gtid": users[0]["gtid"], "barcodes": barcodes})
+    events.clear()
+
+    with count_queries() as queries:
+        response = client.post("/checkout/bulk", json={"gtid": users[0]["gtid"], "barcodes": barcodes})
+    assert response.status_code == 200
+    assert all("error" not in r for r in response.get_json())
+    #the user, the items, their open checkouts, the insert and the events
+    assert len(queries) == 5, queries
+    assert [e["type"] for e in events.received()] == ["checkout"] * n
+
+@pytest.mark.parametrize("n", [1, 20])
+def test_bulk_return(client, seed, count_queries, events, n):
+    users, items = seed(n)
+    events.clear()
+
+    with count_queries() as queries:
+        response = client.delete("/checkout/bulk", json={"gtid": users[0]["gtid"], "barcodes": [i["barcode"] for i in items]})
+    assert response.status_code == 200
+    assert all("error" not in r for r in response.get_json())
+    #the items, their open checkouts with their users, the update and the events
+    assert len(queries) == 4, queries
+    assert [e["type"] for e in events.received()] == ["return"] * n
@@ -0,0 +1,32 @@
+from models import db, Checkout, ItemUsage
+from reports import refresh_item_usage
+
+def usage(item_id):
+    with db.connection_context():
+        row = ItemUsage.get_or_none(ItemUsage.item_id == item_id)
+    return row.checkouts if row is not None else 0
+
+#moving a checkout to another item in the admin panel takes it off the old item's totals too
+def test_checkout_moved_to_another_item(client, seed):
+    users, items = seed(2)
+    with db.connection_context():
+        refresh_item_usage()
+        checkout = Checkout.get(Checkout.item_id == items[0]["id"])
+        #the other item has to be free to take the open checkout
+        Checkout.delete().where(Checkout.item_id == items[1]["id"]).execute()
+        start_date = checkout.start_date
+
+    response = client.post("/admin/checkout/edit/?id={}".format(checkout.id), data={
+        "start_date": start_date.strftime("%Y-%m-%d %H:%M:%S"),
+        "return_date": "",
+        "item_id": items[1]["id"],
+        "user_id": users[0]["id"],
+        "updated_at": start_date.strftime("%Y-%m-%d %H:%M:%S"),
+    })
+    assert response.status_code == 302
+    with db.connection_context():
+        assert Checkout.get_by_id(checkout.id).item_id_id == items[1]["id"]
+        refresh_item_usage()
+
+    assert usage(items[0]["id"]) == 0
+    assert usage(items[1]["id"]) == 1
@@ -0,0 +1,34 @@
+import json
+from datetime import datetime, timedelta
+from models import db, Item, Tombstone, prune_tombstones, TOMBSTONE_RETENTION
+from routes.sync import encode_cursor
+
+def sync(client, when):
+    response = client.get("/sync", query_string={"tables": "items", "cursor": encode_cursor(when)})
+    assert response.status_code == 200
+    return [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+def test_recent_cursor_gets_deletions(client, seed):
+    seed(1)
+    with db.connection_context():
+        item = Item.create(barcode="deleted", name="Deleted")
+        item.delete_instance()
+    changes = sync(client, datetime.now() - timedelta(days=1))
+    assert {"table": "items", "deleted": item.id} in changes
+    assert not any("reset" in c for c in changes)
+
+def test_cursor_older_than_tombstones_is_reset(client, seed):
+    users, items = seed(2)
+    changes = sync(client, datetime.now() - TOMBSTONE_RETENTION - timedelta(days=1))
+    assert changes[0] == {"reset": True}
+    #every row comes back, not just the ones changed since the cursor
+    assert sorted(c["row"]["id"] for c in changes if "row" in c) == sorted(i["id"] for i in items)
+    assert "cursor" in changes[-1]
+
+def test_prune_tombstones(app):
+    with db.connection_context():
+        old = Tombstone.create(table="items", row_id="old", deleted_at=datetime.now() - TOMBSTONE_RETENTION - timedelta(days=1))
+        new = Tombstone.create(table="items", row_id="new")
+        prune_tombstones()
+        assert Tombstone.get_or_none(Tombstone.id == old.id) is None
+        assert Tombstone.get_or_none(Tombstone.id == new.id) is not None